@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+"""
+Benchmark of message body decoding on a synthetic corpus. Compares the previous strategy, which ran
+every text/plain body through html2text, with MIME-aware decoding using each HTML backend.
+
+Run from the repository root: :code:`python benchmarks/decode_bodies.py [-n MESSAGES]`
+"""
+
+import argparse as ap
+import base64
+import email
+import os
+import random
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+)
+
+from Gmailtools import constants  # noqa: E402
+from Gmailtools import utils  # noqa: E402
+
+WORDS = "alpha beta gamma delta invoice meeting <urgent> *note* _draft_ 3<4 café résumé".split()
+
+
+def b64(text):
+    return base64.urlsafe_b64encode(text.encode("UTF-8")).decode("ASCII")
+
+
+def paragraphs(rng, n):
+    return [" ".join(rng.choices(WORDS, k=rng.randint(20, 80))) for _ in range(n)]
+
+
+def text_part(mime_type, text):
+    return {
+        "mimeType": mime_type,
+        "filename": "",
+        "headers": [{"name": "Content-Type", "value": f"{mime_type}; charset=UTF-8"}],
+        "body": {"size": len(text), "data": b64(text)},
+    }
+
+
+def make_payload(rng):
+    """Returns a payload that is multipart/alternative (60%), text/plain only (30%), or text/html only (10%)"""
+    paras = paragraphs(rng, rng.randint(3, 30))
+    plain = "\n\n".join(paras)
+    html = (
+        "<html><head><style>p {margin: 0}</style></head><body>"
+        + "".join(
+            f"<p>{p.replace('<', '&lt;')} <a href='https://example.com/{i}'>link</a></p>"
+            for i, p in enumerate(paras)
+        )
+        + "</body></html>"
+    )
+    kind = rng.random()
+    if kind < 0.6:
+        return {
+            "mimeType": "multipart/alternative",
+            "filename": "",
+            "body": {"size": 0},
+            "parts": [text_part("text/plain", plain), text_part("text/html", html)],
+        }
+    if kind < 0.9:
+        return text_part("text/plain", plain)
+    return text_part("text/html", html)
+
+
+def previous(payload):
+    """Previous strategy: html2text over the re-serialized text/plain part, HTML ignored"""
+    parts, body = [payload], None
+    while parts:
+        cur = parts.pop()
+        parts.extend(cur.get("parts", []))
+        if cur["mimeType"] == "text/plain":
+            message = email.message_from_bytes(
+                base64.urlsafe_b64decode(cur["body"]["data"].encode("ASCII"))
+            )
+            body = utils.html_decoder().handle(str(message))
+    return body
+
+
+def current(backend):
+    def decode(payload):
+        constants.HTML_BACKEND = backend
+        return utils.extract_fields(payload, "id")["body"]
+
+    return decode
+
+
+def main():
+    parser = ap.ArgumentParser(description="Benchmark message body decoding")
+    parser.add_argument("-n", type=int, default=500, help="Number of messages")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = [make_payload(rng) for _ in range(args.n)]
+    print(
+        f"{args.n} messages, {sum(len(str(p)) for p in corpus) / 1024**2:.1f} MiB of payload"
+    )
+    strategies = {
+        "previous (html2text on text/plain)": previous,
+        "MIME-aware, html2text backend": current("html2text"),
+        "MIME-aware, fast backend": current("fast"),
+    }
+    baseline = None
+    for name, decode in strategies.items():
+        start = time.perf_counter()
+        for payload in corpus:
+            decode(payload)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(
+            f"{name:<36} {elapsed:7.3f} s  {1000 * elapsed / args.n:7.3f} ms/message  {baseline / elapsed:6.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+"""
+Startup-time regression benchmark for the command-line programs. Measures the import time of
+:code:`Gmailtools.command` with :code:`python -X importtime` and the wall time of
+:code:`gmail_query_emails --help`, and fails if any library that should be loaded lazily is
+imported at startup or if startup exceeds a time budget.
+
+Run from the repository root: :code:`python benchmarks/import_time.py [--max-ms N]`
+"""
+
+import argparse as ap
+import os
+import subprocess
+import sys
+import time
+
+# Libraries that must only be imported on first use
+LAZY_MODULES = (
+    "googleapiclient",
+    "google.oauth2",
+    "google_auth_oauthlib",
+    "google.auth.transport",
+    "httplib2",
+    "html2text",
+    "requests",
+)
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+
+
+def run(code):
+    env = {**os.environ, "PYTHONPATH": SRC}
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        sys.exit(f"Benchmark command failed:\n{result.stderr}")
+    return elapsed, result.stderr
+
+
+def parse_importtime(output):
+    """Parses :code:`-X importtime` output into a dict of module names and cumulative microseconds"""
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main():
+    parser = ap.ArgumentParser(description="Measure command-line startup time")
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=150,
+        help="Fail if importing Gmailtools.command takes longer than this many milliseconds",
+    )
+    parser.add_argument(
+        "-n", type=int, default=5, help="Number of runs to take the best of"
+    )
+    args = parser.parse_args()
+
+    runs = [run("import Gmailtools.command") for _ in range(args.n)]
+    times = min(
+        (parse_importtime(output) for _, output in runs),
+        key=lambda x: x["Gmailtools.command"],
+    )
+    help_time = min(
+        run(
+            "import sys; sys.argv = ['gmail_query_emails', '-h'];"
+            "from Gmailtools.command import query_emails; query_emails()"
+        )[0]
+        for _ in range(args.n)
+    )
+
+    print(f"import Gmailtools.command: {times['Gmailtools.command'] / 1000:.1f} ms")
+    print(
+        f"gmail_query_emails --help: {help_time * 1000:.1f} ms (wall, incl. interpreter)"
+    )
+    print("Slowest imports (cumulative):")
+    for name, cumulative in sorted(times.items(), key=lambda x: -x[1])[:10]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failures = [
+        name
+        for name in times
+        if any(name == lazy or name.startswith(lazy + ".") for lazy in LAZY_MODULES)
+    ]
+    if failures:
+        sys.exit(f"Imported at startup: {', '.join(sorted(failures))}")
+    if times["Gmailtools.command"] / 1000 > args.max_ms:
+        sys.exit(f"Startup exceeded {args.max_ms} ms")
+
+
+if __name__ == "__main__":
+    main()
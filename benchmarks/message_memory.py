@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""
+Benchmark of the per-message memory overhead of :code:`classes.ParsedMessage` against the previous
+representation, a :code:`dict` subclass storing its fields as instance attributes. Field values are
+shared between messages, so only the cost of the records themselves is measured.
+
+Run from the repository root: :code:`python benchmarks/message_memory.py [-n MESSAGES]`
+"""
+
+import argparse as ap
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+)
+
+from Gmailtools import classes  # noqa: E402
+
+
+class DictParsedMessage(dict):
+    """The previous representation"""
+
+    def __init__(
+        self,
+        id,
+        date,
+        sender=None,
+        recipient=None,
+        body=None,
+        subject=None,
+        attachments=None,
+        gmail_id=None,
+        labels=None,
+        size=None,
+    ):
+        self.id = id
+        self.date = date
+        self.sender = sender
+        self.recipient = recipient
+        self.body = body
+        self.subject = subject
+        self.attachments = {} if attachments is None else attachments
+        self.gmail_id = gmail_id
+        self.labels = [] if labels is None else labels
+        self.size = size
+
+    @property
+    def data(self):
+        return {
+            "From": self.sender,
+            "To": self.recipient,
+            "Subject": self.subject,
+            "Date": self.date,
+            "Body": self.body,
+            "Attachments": len(self.attachments),
+        }
+
+
+FIELDS = {
+    "id": "<message@example.com>",
+    "date": "Mon, 1 Jan 2024 10:00:00 +0000",
+    "sender": "sender@example.com",
+    "recipient": "recipient@example.com",
+    "body": "Hello\n" * 50,
+    "subject": "Quarterly report",
+    "attachments": {},
+    "gmail_id": "18c0ffee",
+    "labels": ["INBOX"],
+    "size": 4096,
+}
+
+
+def measure(cls, n):
+    tracemalloc.start()
+    messages = [cls(**FIELDS) for _ in range(n)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    # As store_messages and print_messages do
+    for _ in range(2):
+        for message in messages:
+            message.data
+    elapsed = time.perf_counter() - start
+    return size / n, elapsed
+
+
+def main():
+    parser = ap.ArgumentParser(description="Measure per-message memory overhead")
+    parser.add_argument("-n", type=int, default=50000, help="Number of messages")
+    args = parser.parse_args()
+
+    print(f"{args.n} messages")
+    baseline = None
+    for name, cls in (
+        ("dict subclass (previous)", DictParsedMessage),
+        ("__slots__ (ParsedMessage)", classes.ParsedMessage),
+    ):
+        per_message, elapsed = measure(cls, args.n)
+        baseline = baseline or per_message
+        print(
+            f"{name:<26} {per_message:7.0f} bytes/message ({per_message / baseline:.0%})  "
+            f"2x .data: {elapsed:.3f} s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+"""
+Benchmark of decoding message resources on a process pool, as :code:`--processes` does, against
+decoding them on the calling thread. Uses the synthetic corpus of :code:`decode_bodies.py` and
+times :code:`utils.parse_message` for several chunk sizes, including the default
+:code:`constants.PARSE_CHUNK_SIZE`.
+
+Run from the repository root: :code:`python benchmarks/parse_processes.py [-n MESSAGES] [-p PROCESSES]`
+"""
+
+import argparse as ap
+import os
+import random
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src")
+)
+
+from decode_bodies import make_payload  # noqa: E402
+from Gmailtools import constants  # noqa: E402
+from Gmailtools import utils  # noqa: E402
+
+
+def make_message(rng, i):
+    payload = make_payload(rng)
+    payload["headers"] = [
+        {"name": "From", "value": f"sender{i}@example.com"},
+        {"name": "Subject", "value": f"Message {i}"},
+        {"name": "Date", "value": "Mon, 1 Jan 2024 10:00:00 +0000"},
+        {"name": "Message-ID", "value": f"<{i}@example.com>"},
+        *payload.get("headers", []),
+    ]
+    return {"id": f"{i:x}", "labelIds": ["INBOX"], "payload": payload}
+
+
+def timed(corpus, executor=None, chunksize=None):
+    start = time.perf_counter()
+    for _ in utils.parse_message(
+        corpus,
+        executor=executor,
+        chunksize=chunksize or constants.PARSE_CHUNK_SIZE,
+        max_pending=2 * (executor._max_workers if executor else 1),
+    ):
+        pass
+    return time.perf_counter() - start
+
+
+def main():
+    parser = ap.ArgumentParser(
+        description="Benchmark decoding messages on a process pool"
+    )
+    parser.add_argument("-n", type=int, default=2000, help="Number of messages")
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes, defaults to the number of CPUs",
+    )
+    parser.add_argument("--backend", default=constants.HTML_BACKEND)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    constants.HTML_BACKEND = args.backend
+
+    rng = random.Random(args.seed)
+    corpus = [make_message(rng, i) for i in range(args.n)]
+    print(
+        f"{args.n} messages, {args.backend} backend, {args.processes} process(es), {os.cpu_count()} CPU(s)"
+    )
+    # Warm up the HTML decoder of the calling thread
+    timed(corpus[:10])
+    baseline = timed(corpus)
+    print(f"{'calling thread':<28} {baseline:7.3f} s")
+    with utils.process_pool(args.processes) as executor:
+        # Start the workers before timing
+        timed(corpus[: 10 * args.processes], executor, 1)
+        for chunksize in sorted({1, constants.PARSE_CHUNK_SIZE, 50, 200}):
+            elapsed = timed(corpus, executor, chunksize)
+            default = " (default)" if chunksize == constants.PARSE_CHUNK_SIZE else ""
+            print(
+                f"{f'pool, chunks of {chunksize}{default}':<28} {elapsed:7.3f} s  {baseline / elapsed:5.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
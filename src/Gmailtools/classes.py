@@ -1,11 +1,36 @@
+import abc
 import argparse as ap
+import base64
+import datetime
+import email.utils
+import errno
+import hashlib
+import html.parser
+import io
+import json
+import re
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 
+from Gmailtools import constants
 from Gmailtools import utils
 
 # import utils
 import sys
 import os
 
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+# Read once, since the umask can only be read by setting it, which is not thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
 
 class TupleDict:
 
@@ -56,7 +81,33 @@ class PartialUpdateDict(dict):
             self.__setitem__(k, new)
 
 
-class ParsedMessage(dict):
+class ParsedMessage:
+    """
+    Fields parsed from an email message. Instances store their fields in :code:`__slots__` rather than
+    a per-instance dict, and cache :code:`data` and :code:`to_json`; setting a field clears the
+    caches, but mutating :code:`attachments` or :code:`labels` in place does not.
+
+    :param id: RFC 2822 Message-ID
+    :type id: str
+    :param date: Date header
+    :type date: str
+    """
+
+    # Serialized fields, in the order of to_dict
+    FIELDS = (
+        "id",
+        "date",
+        "sender",
+        "recipient",
+        "body",
+        "subject",
+        "attachments",
+        "gmail_id",
+        "labels",
+        "size",
+    )
+    __slots__ = FIELDS + ("_data", "_json")
+
     def __init__(
         self,
         id,
@@ -66,6 +117,9 @@ class ParsedMessage(dict):
         body=None,
         subject=None,
         attachments=None,
+        gmail_id=None,
+        labels=None,
+        size=None,
     ):
         self.id = id
         self.date = date
@@ -74,6 +128,53 @@ class ParsedMessage(dict):
         self.body = body
         self.subject = subject
         self.attachments = {} if attachments is None else attachments
+        self.gmail_id = gmail_id
+        self.labels = [] if labels is None else labels
+        self.size = size
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in ParsedMessage.FIELDS:
+            object.__setattr__(self, "_data", None)
+            object.__setattr__(self, "_json", None)
+
+    def to_dict(self):
+        """Serializes the message to a JSON-compatible dict, with keys in the order of :code:`FIELDS`"""
+        return {
+            "id": self.id,
+            "date": self.date,
+            "sender": self.sender,
+            "recipient": self.recipient,
+            "body": self.body,
+            "subject": self.subject,
+            "attachments": {k: v.to_dict() for k, v in self.attachments.items()},
+            "gmail_id": self.gmail_id,
+            "labels": self.labels,
+            "size": self.size,
+        }
+
+    def to_json(self):
+        """Returns :code:`to_dict` serialized as JSON, computing it on first use"""
+        if self._json is None:
+            object.__setattr__(self, "_json", json.dumps(self.to_dict()))
+        return self._json
+
+    @classmethod
+    def from_dict(cls, di):
+        """Inverse of :code:`to_dict`"""
+        attachments = {k: AttachmentHandle(**v) for k, v in di["attachments"].items()}
+        return cls(**{**di, "attachments": attachments})
+
+    @property
+    def timestamp(self):
+        """The Date header as a UTC datetime, or :code:`None` if it is missing or unparseable"""
+        try:
+            date = email.utils.parsedate_to_datetime(self.date)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            return date.replace(tzinfo=datetime.timezone.utc)
+        return date.astimezone(datetime.timezone.utc)
 
     @property
     def _longest_attachment(self):
@@ -89,21 +190,30 @@ class ParsedMessage(dict):
 
     @property
     def data(self):
-        return {
-            "From": self.sender,
-            "To": self.recipient,
-            "Subject": self.subject,
-            "Date": self.date,
-            "Body": self.body,
-            "Attachments": self.n_attachments,
-        }
+        """Dict of the fields shown to users, computed on first use. Do not modify it."""
+        if self._data is None:
+            object.__setattr__(
+                self,
+                "_data",
+                {
+                    "From": self.sender,
+                    "To": self.recipient,
+                    "Subject": self.subject,
+                    "Date": self.date,
+                    "Body": self.body,
+                    "Attachments": self.n_attachments,
+                },
+            )
+        return self._data
 
     def __repr__(self):
         out = utils.format_print_dict(
             {k: v for k, v in self.data.items() if k != "Attachments"}
         )
         if self.n_attachments > 0:
-
+            # Bodies converted from HTML end with a newline, but plain text ones may not
+            if not out.endswith("\n"):
+                out += "\n"
             out += "Attachments:\n" + "\n".join(
                 (
                     OptionsMenu.sequential_number(
@@ -114,6 +224,700 @@ class ParsedMessage(dict):
         return out
 
 
+class AttachmentHandle:
+    """
+    Lightweight reference to a message attachment. Its content is retrieved from the API
+    only when read, unless it was sent inline with the message.
+
+    :param name: File name of the attachment.
+    :type name: str
+    :param message_id: Gmail ID of the message containing the attachment.
+    :type message_id: str
+    :param attachment_id: Gmail ID of the attachment.
+    :type attachment_id: str
+    :param size: Size of the attachment in bytes.
+    :type size: int, optional
+    :param mime_type: MIME type of the attachment.
+    :type mime_type: str, optional
+    :param data: Base64-encoded content of the attachment, if sent inline.
+    :type data: str, optional
+    """
+
+    def __init__(
+        self, name, message_id, attachment_id, size=None, mime_type=None, data=None
+    ):
+        self.name = name
+        self.message_id = message_id
+        self.attachment_id = attachment_id
+        self.size = size
+        self.mime_type = mime_type
+        self.data = data
+
+    def read(self, gmail_service, http=None):
+        """Returns the decoded content of the attachment, retrieving it if necessary"""
+        data = self.data
+        if data is None:
+            data = utils.get_attachment_data(
+                gmail_service, self.message_id, self.attachment_id, http=http
+            )
+        return base64.urlsafe_b64decode(data.encode("UTF-8"))
+
+    def write_to(
+        self, gmail_service, path, buffer_size=constants.DOWNLOAD_BUFFER_SIZE, http=None
+    ):
+        """
+        Writes the decoded content of the attachment to a path, retrieving it if necessary. Content
+        is decoded and written :code:`buffer_size` bytes at a time to a temporary file in the same directory,
+        which is then renamed to :code:`path`, so a partial download never replaces an existing file.
+
+        :param gmail_service: Gmail API client object
+        :type gmail_service: googleapiclient.discovery.Resource
+        :param path: Destination path.
+        :type path: str
+        :param buffer_size: Approximate number of bytes to decode at a time, defaults to :code:`constants.DOWNLOAD_BUFFER_SIZE`.
+        :type buffer_size: int, optional
+        :param http: HTTP object to retrieve the attachment with, defaults to that of :code:`gmail_service`.
+        :type http: httplib2.Http, optional
+        :return: Number of bytes written.
+        :rtype: int
+        """
+        data = self.data
+        if data is None:
+            data = utils.get_attachment_data(
+                gmail_service, self.message_id, self.attachment_id, http=http
+            )
+        # Each 4 base64 characters decode to 3 bytes
+        step = max(buffer_size // 3, 1) * 4
+        written = 0
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(path)), prefix=".", delete=False
+        ) as f:
+            try:
+                for start in range(0, len(data), step):
+                    chunk = data[start : start + step]
+                    chunk += "=" * (-len(chunk) % 4)
+                    written += f.write(base64.urlsafe_b64decode(chunk.encode("ASCII")))
+            except BaseException:
+                os.remove(f.name)
+                raise
+        # Temporary files are private; apply the permissions open would have
+        os.chmod(f.name, 0o666 & ~_UMASK)
+        os.replace(f.name, path)
+        return written
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "message_id": self.message_id,
+            "attachment_id": self.attachment_id,
+            "size": self.size,
+            "mime_type": self.mime_type,
+            "data": self.data,
+        }
+
+    def __repr__(self):
+        return f"AttachmentHandle({self.name!r}, {self.size} bytes, {self.mime_type})"
+
+
+class AttachmentStore:
+    """
+    Content-addressed store of attachments, keyed by the SHA-256 hash of their decoded content.
+    A manifest maps each message ID and file name to a hash, so attachments already in the store
+    are never downloaded or written again; they are hard-linked (or, failing that, symlinked) into the
+    destination directory instead. Stored files are made read-only, so editing a linked copy cannot
+    change the stored content or the other copies linked to it.
+
+    :param path: Directory of the store, created if it does not exist. Defaults to :code:`constants.ATTACHMENT_STORE_PATH`.
+    :type path: str, optional
+    """
+
+    def __init__(self, path=constants.ATTACHMENT_STORE_PATH):
+        self.path = path
+        self.manifest_path = os.path.join(path, "manifest.json")
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+        # Entries added since the manifest was read
+        self._added = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def object_path(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest)
+
+    def fetch(
+        self,
+        gmail_service,
+        handle,
+        path,
+        buffer_size=constants.DOWNLOAD_BUFFER_SIZE,
+        http=None,
+    ):
+        """
+        Links an attachment into :code:`path`, first downloading it into the store if it is not there.
+
+        :return: Number of bytes downloaded, or :code:`None` if the attachment was already stored.
+        :rtype: int
+        """
+        key = f"{handle.message_id}/{handle.name}"
+        digest = self.manifest.get(key)
+        written = None
+        if digest is None or not os.path.exists(self.object_path(digest)):
+            with tempfile.TemporaryDirectory(dir=self.path) as tmp:
+                download = os.path.join(tmp, "download")
+                written = handle.write_to(
+                    gmail_service, download, buffer_size=buffer_size, http=http
+                )
+                digest = self._hash(download)
+                destination = self.object_path(digest)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                # Identical content from another message is already stored
+                if not os.path.exists(destination):
+                    os.chmod(download, 0o444 & ~_UMASK)
+                    os.replace(download, destination)
+            with self._lock:
+                self.manifest[key] = self._added[key] = digest
+        self._link(self.object_path(digest), path)
+        return written
+
+    @staticmethod
+    def _hash(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(constants.DOWNLOAD_BUFFER_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _link(source, path):
+        # Objects stored before they were made read-only
+        if os.stat(source).st_mode & 0o222:
+            os.chmod(source, 0o444 & ~_UMASK)
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(source, path)
+        except OSError:
+            # Hard links cannot cross file systems
+            os.symlink(source, path)
+
+    def close(self):
+        """
+        Saves the manifest. Entries added since it was read are merged into the saved manifest
+        under a lock, since other processes may have updated it in the meantime.
+        """
+        with self._lock, _FileLock(self.manifest_path + ".lock"):
+            if not self._added:
+                return
+            try:
+                with open(self.manifest_path) as f:
+                    self.manifest = json.load(f)
+            except FileNotFoundError:
+                self.manifest = {}
+            self.manifest.update(self._added)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.path, prefix=".", delete=False
+            ) as f:
+                json.dump(self.manifest, f)
+            os.chmod(f.name, 0o666 & ~_UMASK)
+            os.replace(f.name, self.manifest_path)
+            self._added = {}
+
+
+class HTMLTextExtractor(html.parser.HTMLParser):
+    """
+    Fast converter of HTML to plain text. Keeps the text of the document and the targets of links,
+    breaking lines at block elements and dropping scripts, styles, images, and all formatting.
+    Use :code:`convert` rather than feeding the parser directly.
+    """
+
+    BLOCK_TAGS = set(
+        "address blockquote br div dl dt dd h1 h2 h3 h4 h5 h6 hr li ol p pre table tr ul".split()
+    )
+    SKIP_TAGS = {"head", "script", "style", "title"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip = 0
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+            if tag == "li":
+                self.parts.append("* ")
+        elif tag == "a":
+            self.links.append(dict(attrs).get("href"))
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        # List items are already separated by their start tags
+        elif tag in self.BLOCK_TAGS and tag != "li":
+            self.parts.append("\n")
+        elif tag == "a" and self.links:
+            href = self.links.pop()
+            if href and not href.startswith("#") and not self.skip:
+                self.parts.append(f" <{href}>")
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+    @classmethod
+    def convert(cls, text):
+        """Returns the text of an HTML document"""
+        parser = cls()
+        parser.feed(text)
+        parser.close()
+        text = re.sub(r"[ \t\r\f\v]+", " ", "".join(parser.parts))
+        text = "\n".join(line.strip() for line in text.split("\n"))
+        return re.sub(r"\n{3,}", "\n\n", text).strip() + "\n"
+
+
+class FrameWriter(io.TextIOBase):
+    """
+    Text stream that forwards everything written to it to a :code:`gmail_client` connection as
+    a newline-delimited JSON frame of the form :code:`{key: text}`. Writes from several threads
+    are serialized.
+
+    :param stream: Text stream of the client connection
+    :type stream: io.TextIOBase
+    :param key: Name of the client stream the text is written to, :code:`"stdout"` or :code:`"stderr"`
+    :type key: str
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, stream, key):
+        self.stream = stream
+        self.key = key
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if text:
+            with self._lock:
+                self.stream.write(json.dumps({self.key: text}) + "\n")
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            self.stream.flush()
+
+
+class Transport(abc.ABC):
+    """
+    Base class of HTTP transports that stand in for :code:`httplib2.Http` in API clients, sharing one
+    pool of keep-alive connections between all threads. Subclasses implement :code:`_send` and
+    :code:`connections`, and map their network errors onto the socket errors the API client retries
+    in :code:`_map_error`.
+
+    :param credentials: Credentials used to authorize requests
+    :type credentials: google.auth.credentials.Credentials
+    :param pool_size: Maximum number of connections kept alive, defaults to :code:`constants.POOL_SIZE`.
+    :type pool_size: int, optional
+    """
+
+    name = None
+
+    def __init__(self, credentials, pool_size=constants.POOL_SIZE):
+        self.credentials = credentials
+        self.pool_size = pool_size
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def request(
+        self,
+        uri,
+        method="GET",
+        body=None,
+        headers=None,
+        redirections=None,
+        connection_type=None,
+    ):
+        """Sends a request, returning an :code:`httplib2.Response` and the response body as :code:`httplib2.Http.request` does"""
+        import httplib2
+
+        try:
+            status, reason, response_headers, content = self._send(
+                method, uri, body, headers or {}
+            )
+        except Exception as e:
+            mapped = self._map_error(e)
+            if mapped is None:
+                raise
+            raise mapped from e
+        with self._lock:
+            self.requests += 1
+        # The body has already been decompressed
+        response_headers = {
+            k: v for k, v in response_headers.items() if k.lower() != "content-encoding"
+        }
+        response = httplib2.Response({**response_headers, "status": status})
+        response.reason = reason
+        return response, content
+
+    @abc.abstractmethod
+    def _send(self, method, uri, body, headers):
+        """Sends a request, returning its status code, reason, headers and decompressed body"""
+
+    @abc.abstractmethod
+    def connections(self):
+        """Returns the number of connections opened so far"""
+
+    def _map_error(self, error):
+        """
+        Returns the exception raised in place of :code:`error`, an exception raised by :code:`_send`, or
+        :code:`None` to raise it unchanged. The API client only retries requests that fail with
+        :code:`socket.timeout`, :code:`ConnectionError` or :code:`httplib2` errors, as :code:`httplib2.Http`
+        raises, so timeouts and connection failures of other HTTP libraries are mapped onto those.
+        """
+        return None
+
+    def stats(self):
+        """Returns a dict of the number of requests sent and connections opened"""
+        return {"requests": self.requests, "connections": self.connections()}
+
+    def format(self):
+        stats = self.stats()
+        reused = stats["requests"] - stats["connections"]
+        return (
+            f"{self.name}: {stats['requests']} request(s) over {stats['connections']} connection(s), "
+            f"{max(reused, 0)} reused"
+        )
+
+    def close(self):
+        pass
+
+
+class RequestsTransport(Transport):
+    """Transport over a :code:`google.auth.transport.requests.AuthorizedSession` with a urllib3 connection pool"""
+
+    name = "requests"
+
+    def __init__(self, credentials, pool_size=constants.POOL_SIZE):
+        from google.auth.transport.requests import AuthorizedSession
+        from requests.adapters import HTTPAdapter
+
+        super().__init__(credentials, pool_size)
+        self.session = AuthorizedSession(credentials)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+
+    def _send(self, method, uri, body, headers):
+        response = self.session.request(method, uri, data=body, headers=headers)
+        return response.status_code, response.reason, response.headers, response.content
+
+    def _map_error(self, error):
+        import requests
+
+        if isinstance(error, requests.Timeout):
+            return socket.timeout(str(error))
+        if isinstance(error, requests.ConnectionError):
+            return ConnectionResetError(errno.ECONNRESET, str(error))
+        return None
+
+    def connections(self):
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def close(self):
+        self.session.close()
+
+
+class HttpxTransport(Transport):
+    """Transport over an :code:`httpx.Client`, which negotiates HTTP/2 if the :code:`h2` package is installed"""
+
+    name = "httpx"
+
+    def __init__(self, credentials, pool_size=constants.POOL_SIZE):
+        import httpx
+
+        super().__init__(credentials, pool_size)
+        try:
+            import h2  # noqa: F401
+
+            http2 = True
+        except ImportError:
+            http2 = False
+        self.client = httpx.Client(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+        )
+        self.opened = 0
+        self.http2 = 0
+
+    def _trace(self, event, info):
+        if event == "connection.connect_tcp.complete":
+            with self._lock:
+                self.opened += 1
+
+    def _send(self, method, uri, body, headers):
+        from google.auth.transport.requests import Request
+
+        # Refresh and retry once if the token was rejected
+        for attempt in range(2):
+            if not self.credentials.valid or attempt:
+                with self._lock:
+                    self.credentials.refresh(Request())
+            request_headers = dict(headers)
+            self.credentials.apply(request_headers)
+            response = self.client.request(
+                method,
+                uri,
+                content=body,
+                headers=request_headers,
+                extensions={"trace": self._trace},
+            )
+            if response.status_code != 401:
+                break
+        if response.http_version == "HTTP/2":
+            with self._lock:
+                self.http2 += 1
+        return (
+            response.status_code,
+            response.reason_phrase,
+            response.headers,
+            response.content,
+        )
+
+    def _map_error(self, error):
+        import httpx
+
+        if isinstance(error, httpx.TimeoutException):
+            return socket.timeout(str(error))
+        if isinstance(error, httpx.TransportError):
+            return ConnectionResetError(errno.ECONNRESET, str(error))
+        return None
+
+    def connections(self):
+        return self.opened
+
+    def stats(self):
+        return {**super().stats(), "http2": self.http2}
+
+    def format(self):
+        return f"{super().format()}, {self.http2} over HTTP/2"
+
+    def close(self):
+        self.client.close()
+
+
+class RateLimiter:
+    """Thread-safe limiter spacing calls at least :code:`1 / rate` seconds apart"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until the next call is allowed"""
+        with self._lock:
+            now = time.monotonic()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class DiscoveryCache:
+    """
+    On-disk cache of API discovery documents, implementing the interface of
+    :code:`googleapiclient.discovery_cache.base.Cache`. Only needed for client library
+    versions that predate bundled discovery documents.
+
+    :param path: Directory of the cache, defaults to :code:`constants.DISCOVERY_CACHE_PATH`.
+    :type path: str, optional
+    :param max_age: Seconds for which a cached document is used, defaults to :code:`constants.DISCOVERY_CACHE_MAX_AGE`.
+    :type max_age: int, optional
+    """
+
+    def __init__(
+        self,
+        path=constants.DISCOVERY_CACHE_PATH,
+        max_age=constants.DISCOVERY_CACHE_MAX_AGE,
+    ):
+        self.path = path
+        self.max_age = max_age
+
+    def _file(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode("UTF-8")).hexdigest())
+
+    def get(self, url):
+        try:
+            if time.time() - os.path.getmtime(self._file(url)) > self.max_age:
+                return None
+            with open(self._file(url)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.path, prefix=".", delete=False
+            ) as f:
+                f.write(content)
+            os.replace(f.name, self._file(url))
+        except OSError:
+            pass
+
+
+class TokenCache:
+    """
+    Saved OAuth credentials shared by every process that uses the same token file. Access
+    tokens are refreshed shortly before they expire, and refreshed tokens are written back
+    atomically. Refreshes are serialized with an exclusive lock on a companion :code:`.lock`
+    file, so concurrent processes refresh at most once between them; the lock is skipped on
+    platforms without :code:`fcntl`.
+
+    :param path: Path to the token JSON file
+    :type path: str
+    :param scopes: Authorization scopes of the credentials
+    :type scopes: List[str]
+    :param margin: Seconds before expiry at which tokens are refreshed, defaults to :code:`constants.TOKEN_REFRESH_MARGIN`.
+    :type margin: int, optional
+    """
+
+    def __init__(self, path, scopes, margin=constants.TOKEN_REFRESH_MARGIN):
+        self.path = path
+        self.scopes = scopes
+        self.margin = datetime.timedelta(seconds=margin)
+
+    def load(self):
+        """Returns the saved credentials, or :code:`None` if there are none"""
+        from google.oauth2.credentials import Credentials
+
+        if not os.path.exists(self.path):
+            return None
+        return Credentials.from_authorized_user_file(self.path, self.scopes)
+
+    def save(self, creds):
+        """Atomically replaces the token file with :code:`creds`, readable only by the owner"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile(
+            "w", dir=directory, prefix=".", delete=False
+        ) as f:
+            os.chmod(f.name, 0o600)
+            f.write(creds.to_json())
+        os.replace(f.name, self.path)
+
+    def expiring(self, creds):
+        """Indicates whether :code:`creds` are invalid or expire within the refresh margin"""
+        if not creds.valid:
+            return True
+        # Credentials store expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return creds.expiry is not None and creds.expiry - self.margin <= now
+
+    def lock(self):
+        """Returns a context manager holding an exclusive lock on the token file"""
+        return _FileLock(self.path + ".lock")
+
+    def refresh(self, creds):
+        """
+        Refreshes :code:`creds` if they are about to expire and saves the result. If another
+        process refreshed the saved token while this one waited for the lock, the saved
+        credentials are returned instead.
+
+        :param creds: Credentials to refresh. Must have a refresh token.
+        :type creds: google.oauth2.credentials.Credentials
+        """
+        from google.auth.transport.requests import Request
+
+        if not self.expiring(creds):
+            return creds
+        with self.lock():
+            saved = self.load()
+            if saved and not self.expiring(saved):
+                return saved
+            creds.refresh(Request())
+            try:
+                self.save(creds)
+            except OSError as e:
+                print(f"Error writing token: {e}", file=sys.stderr)
+        return creds
+
+
+class _FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            try:
+                self.file = open(self.path, "a")
+                fcntl.flock(self.file, fcntl.LOCK_EX)
+            except OSError:
+                self.__exit__()
+        return self
+
+    def __exit__(self, *args):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class TransferStats:
+    """Thread-safe record of completed and failed file transfers and their throughput"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.files = 0
+        self.failed = 0
+        self.linked = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def format(nbytes, seconds):
+        """Formats a byte count and duration as size and throughput in MB"""
+        rate = nbytes / 1e6 / seconds if seconds > 0 else float("inf")
+        return f"{nbytes / 1e6:.2f} MB in {seconds:.2f}s ({rate:.2f} MB/s)"
+
+    def record(self, nbytes, seconds):
+        """Records a completed transfer of :code:`nbytes` bytes taking :code:`seconds` seconds, returning a formatted description"""
+        with self._lock:
+            self.files += 1
+            self.bytes += nbytes
+        return self.format(nbytes, seconds)
+
+    def record_link(self):
+        with self._lock:
+            self.linked += 1
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def summary(self):
+        out = f"{self.files} file(s), {self.format(self.bytes, time.perf_counter() - self.start)}"
+        if self.linked:
+            out += f", {self.linked} linked from store"
+        if self.failed:
+            out += f", {self.failed} failed"
+        return out
+
+
 class QueryAction(ap.Action):
     """General action class for email query parameters"""
 
@@ -174,15 +978,22 @@ class QueryAction(ap.Action):
 
 class MaxAction(ap.Action):
     """Special action to ensure :code:`max_emails` parameter
-    is between 1 and 500 inclusive"""
+    is a positive integer, or "all" to return every matching email"""
 
     def __call__(self, parser, namespace, argument_values, option_strings=None):
         if argument_values is None:
             argument_values = 500
-        elif argument_values < 1 or argument_values > 500 or argument_values % 1 != 0:
-            sys.exit(
-                f"Invalid max {argument_values}. Must be integer between 1 and 500 inclusive."
-            )
+        elif argument_values == "all":
+            argument_values = None
+        else:
+            try:
+                argument_values = int(argument_values)
+                if argument_values < 1:
+                    raise ValueError
+            except ValueError:
+                sys.exit(
+                    f"Invalid max {argument_values}. Must be a positive integer or 'all'."
+                )
         setattr(namespace, "max_emails", argument_values)
 
 
@@ -238,6 +1049,476 @@ class OptionsMenu:
         return response
 
 
+class MessageCache:
+    """
+    On-disk SQLite cache of parsed messages keyed by Gmail message ID. Gmail messages
+    are immutable apart from their labels, so cached entries never need revalidation, though
+    their labels may be out of date. The least recently used entries are evicted once the
+    total size of the cache exceeds :code:`max_bytes`.
+
+    :param path: Path to the SQLite database, created if it does not exist. Defaults to :code:`constants.CACHE_PATH`.
+    :type path: str, optional
+    :param max_bytes: Maximum total size of cached entries, defaults to :code:`constants.CACHE_MAX_BYTES`. If :code:`None`, entries are never evicted.
+    :type max_bytes: int, optional
+    """
+
+    def __init__(self, path=constants.CACHE_PATH, max_bytes=constants.CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self._create_tables()
+        # Discard entries serialized in an older format
+        if (
+            self.connection.execute("PRAGMA user_version").fetchone()[0]
+            != constants.CACHE_VERSION
+        ):
+            self.clear()
+            self.connection.execute(f"PRAGMA user_version = {constants.CACHE_VERSION}")
+
+    def _create_tables(self):
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS messages
+            (id TEXT PRIMARY KEY, data TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS messages_accessed ON messages (accessed)"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_many(self, ids):
+        """Returns a dict mapping each cached ID in :code:`ids` to its :code:`ParsedMessage`, marking each as used"""
+        ids = list(ids)
+        if not ids:
+            return {}
+        placeholders = ", ".join("?" * len(ids))
+        with self.connection:
+            rows = self.connection.execute(
+                f"SELECT id, data FROM messages WHERE id IN ({placeholders})", ids
+            ).fetchall()
+            self.connection.execute(
+                f"UPDATE messages SET accessed = ? WHERE id IN ({placeholders})",
+                [time.time(), *ids],
+            )
+        return {k: ParsedMessage.from_dict(json.loads(v)) for k, v in rows}
+
+    def put(self, message):
+        """Adds or replaces a :code:`ParsedMessage` in the cache"""
+        data = message.to_json()
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)",
+                (message.gmail_id, data, len(data), time.time()),
+            )
+
+    def evict(self):
+        """Deletes least recently used entries until the cache is within its size limit"""
+        if self.max_bytes is None:
+            return
+        with self.connection:
+            excess = (
+                self.connection.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM messages"
+                ).fetchone()[0]
+                - self.max_bytes
+            )
+            rows = self.connection.execute(
+                "SELECT id, size FROM messages ORDER BY accessed"
+            )
+            evicted = []
+            for id, size in rows:
+                if excess <= 0:
+                    break
+                evicted.append((id,))
+                excess -= size
+            self.connection.executemany("DELETE FROM messages WHERE id = ?", evicted)
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM messages")
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+
+class LocalStore(MessageCache):
+    """
+    Local mirror of a mailbox, or the messages with a given label, maintained by :code:`gmail_sync`.
+    Unlike its parent class, entries are never evicted, and label changes are applied to stored messages.
+    Sync state, such as the last history ID, is kept in a key-value table.
+
+    :param path: Path to the SQLite database, created if it does not exist. Defaults to :code:`constants.STORE_PATH`.
+    :type path: str, optional
+    """
+
+    def __init__(self, path=constants.STORE_PATH):
+        super().__init__(path, max_bytes=None)
+
+    def _create_tables(self):
+        super()._create_tables()
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS message_index
+                (id TEXT PRIMARY KEY, rfc_id TEXT, sender TEXT, recipient TEXT, subject TEXT, date REAL);
+            CREATE INDEX IF NOT EXISTS message_index_date ON message_index (date);
+            CREATE INDEX IF NOT EXISTS message_index_sender ON message_index (sender);
+            CREATE INDEX IF NOT EXISTS message_index_rfc_id ON message_index (rfc_id);
+            CREATE TABLE IF NOT EXISTS message_labels (id TEXT, label TEXT);
+            CREATE INDEX IF NOT EXISTS message_labels_label ON message_labels (label, id);
+            CREATE INDEX IF NOT EXISTS message_labels_id ON message_labels (id);
+            CREATE TABLE IF NOT EXISTS filenames (id TEXT, name TEXT);
+            CREATE INDEX IF NOT EXISTS filenames_id ON filenames (id);
+            CREATE TABLE IF NOT EXISTS terms (word TEXT, id TEXT);
+            CREATE INDEX IF NOT EXISTS terms_word ON terms (word, id);
+            CREATE INDEX IF NOT EXISTS terms_id ON terms (id);
+            """)
+
+    def put(self, message):
+        """Adds or replaces a :code:`ParsedMessage`, updating the search indexes"""
+        super().put(message)
+        id = message.gmail_id
+        try:
+            date = email.utils.parsedate_to_datetime(message.date).timestamp()
+        except (TypeError, ValueError):
+            date = None
+        words = set(
+            re.findall(
+                r"\w+",
+                " ".join(
+                    x or "" for x in (message.sender, message.subject, message.body)
+                ).lower(),
+            )
+        )
+        with self.connection:
+            self._unindex([id])
+            self.connection.execute(
+                "INSERT INTO message_index VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    id,
+                    message.id,
+                    (message.sender or "").lower(),
+                    (message.recipient or "").lower(),
+                    (message.subject or "").lower(),
+                    date,
+                ),
+            )
+            self.connection.executemany(
+                "INSERT INTO message_labels VALUES (?, ?)",
+                [(id, label) for label in message.labels],
+            )
+            self.connection.executemany(
+                "INSERT INTO filenames VALUES (?, ?)",
+                [(id, name.lower()) for name in message.attachments.keys()],
+            )
+            self.connection.executemany(
+                "INSERT INTO terms VALUES (?, ?)", [(word, id) for word in words]
+            )
+
+    def _unindex(self, ids):
+        for table in ("message_index", "message_labels", "filenames", "terms"):
+            self.connection.executemany(
+                f"DELETE FROM {table} WHERE id = ?", [(id,) for id in ids]
+            )
+
+    def get_state(self, key, default=None):
+        row = self.connection.execute(
+            "SELECT value FROM state WHERE key = ?", (key,)
+        ).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_state(self, key, value):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO state VALUES (?, ?)", (key, json.dumps(value))
+            )
+
+    def ids(self):
+        """Returns the set of Gmail IDs of all stored messages"""
+        return {row[0] for row in self.connection.execute("SELECT id FROM messages")}
+
+    def delete(self, ids):
+        ids = list(ids)
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM messages WHERE id = ?", [(id,) for id in ids]
+            )
+            self._unindex(ids)
+
+    def set_labels(self, labels):
+        """
+        Replaces the label IDs of stored messages, skipping messages that are not stored. Only
+        the labels are reindexed.
+
+        :param labels: Label IDs of each message, keyed by Gmail ID
+        :type labels: Dict[str, List[str]]
+        :return: Number of stored messages whose labels changed.
+        :rtype: int
+        """
+        changed = 0
+        for chunk in utils.chunked(labels, constants.BATCH_SIZE):
+            messages = [
+                message
+                for id, message in self.get_many(chunk).items()
+                if set(message.labels) != set(labels[id])
+            ]
+            with self.connection:
+                for message in messages:
+                    message.labels = list(labels[message.gmail_id])
+                    super().put(message)
+                    self.connection.execute(
+                        "DELETE FROM message_labels WHERE id = ?", (message.gmail_id,)
+                    )
+                    self.connection.executemany(
+                        "INSERT INTO message_labels VALUES (?, ?)",
+                        [(message.gmail_id, label) for label in message.labels],
+                    )
+            changed += len(messages)
+        return changed
+
+    def clear(self):
+        with self.connection:
+            for table in (
+                "messages",
+                "state",
+                "message_index",
+                "message_labels",
+                "filenames",
+                "terms",
+            ):
+                self.connection.execute(f"DELETE FROM {table}")
+
+    def is_fresh(self, max_age=constants.STORE_MAX_AGE):
+        """Whether the store mirrors the whole mailbox and was synced within :code:`max_age` seconds"""
+        synced = self.get_state("synced")
+        return (
+            synced is not None
+            and self.get_state("labelId") is None
+            and time.time() - synced <= max_age
+        )
+
+    def search(self, query, max_emails=None):
+        """
+        Evaluates a Gmail search query against the store, returning the Gmail IDs of matching messages,
+        newest first. Quoted phrases match messages containing all their words, regardless of order.
+
+        :param query: Gmail search query, as built by :code:`QueryAction`.
+        :type query: str
+        :param max_emails: Maximum number of IDs to return, defaults to :code:`None` (no limit).
+        :type max_emails: int, optional
+        :raises UnsupportedQueryError: Raised if the query uses an operator the store cannot evaluate.
+        """
+        tree = GmailQuery(query).parse()
+        condition, params = self._compile(tree)
+        # Like Gmail, leave out spam and trash unless the query asks for them
+        if not self._searches_spam_trash(tree):
+            condition = (
+                f"({condition}) AND id NOT IN "
+                "(SELECT id FROM message_labels WHERE label IN ('SPAM', 'TRASH'))"
+            )
+        sql = f"SELECT id FROM message_index WHERE {condition} ORDER BY date DESC"
+        if max_emails is not None:
+            sql += " LIMIT ?"
+            params.append(max_emails)
+        return [row[0] for row in self.connection.execute(sql, params)]
+
+    def iter_messages(self, ids):
+        """Yields the stored :code:`ParsedMessage` for each ID, in order"""
+        for chunk in utils.chunked(ids, constants.BATCH_SIZE):
+            messages = self.get_many(chunk)
+            yield from (messages[id] for id in chunk if id in messages)
+
+    @classmethod
+    def _searches_spam_trash(cls, node):
+        """Whether a parsed query uses :code:`in:spam`, :code:`in:trash`, or :code:`in:anywhere`"""
+        kind = node[0]
+        if kind in ("and", "or"):
+            return any(cls._searches_spam_trash(child) for child in node[1])
+        if kind == "not":
+            return cls._searches_spam_trash(node[1])
+        _, key, value = node
+        return key == "in" and value.lower() in ("spam", "trash", "anywhere")
+
+    @staticmethod
+    def _like(column, value):
+        """Returns a condition that :code:`column` contains :code:`value`, treating LIKE wildcards in it literally"""
+        value = re.sub(r"([\\%_])", r"\\\1", value)
+        return f"{column} LIKE ? ESCAPE '\\'", [f"%{value}%"]
+
+    def _compile(self, node):
+        """Translates a parsed query into an SQL condition on :code:`message_index` and its parameters"""
+        kind = node[0]
+        if kind in ("and", "or"):
+            if not node[1]:
+                return "1", []
+            compiled = [self._compile(child) for child in node[1]]
+            joiner = " AND " if kind == "and" else " OR "
+            return (
+                joiner.join(f"({condition})" for condition, _ in compiled),
+                [param for _, params in compiled for param in params],
+            )
+        if kind == "not":
+            condition, params = self._compile(node[1])
+            return f"NOT ({condition})", params
+
+        _, key, raw = node
+        value = raw.lower()
+        if key is None:
+            words = re.findall(r"\w+", value)
+            return (
+                " AND ".join(
+                    ["id IN (SELECT id FROM terms WHERE word = ?)"] * len(words)
+                )
+                or "1",
+                words,
+            )
+        if key == "from":
+            return self._like("sender", value)
+        if key == "to":
+            return self._like("recipient", value)
+        if key == "subject":
+            return self._like("subject", value)
+        if key == "in" and value == "anywhere":
+            return "1", []
+        if key == "rfc822msgid":
+            raw = raw.strip("<>")
+            return "rfc_id IN (?, ?)", [raw, f"<{raw}>"]
+        if key == "filename":
+            return (
+                "id IN (SELECT id FROM filenames WHERE name = ? OR name LIKE ?)",
+                [value, f"%.{value}"],
+            )
+        if key in ("before", "after"):
+            timestamp = self._parse_date(value)
+            return ("date < ?" if key == "before" else "date >= ?"), [timestamp]
+        if key == "has" and value == "attachment":
+            return "id IN (SELECT id FROM filenames)", []
+        if key == "is" and value == "read":
+            return self._compile(("not", ("term", "is", "unread")))
+        if key == "category":
+            labels = [
+                (
+                    "CATEGORY_PERSONAL"
+                    if value == "primary"
+                    else f"CATEGORY_{value.upper()}"
+                )
+            ]
+        elif key in ("label", "in", "is"):
+            labels = self._label_ids(raw)
+        else:
+            raise UnsupportedQueryError(f"{key}:{value}")
+        placeholders = ", ".join("?" * len(labels))
+        return (
+            f"id IN (SELECT id FROM message_labels WHERE label IN ({placeholders}))",
+            labels,
+        )
+
+    def _label_ids(self, name):
+        """Returns IDs of labels matching a label name as written in a query"""
+
+        def normalize(x):
+            return re.sub(r"[\s/-]+", "-", x.lower())
+
+        names = self.get_state("labelNames", {})
+        return [name, name.upper()] + [
+            k for k, v in names.items() if normalize(v) == normalize(name)
+        ]
+
+    @staticmethod
+    def _parse_date(value):
+        if value.isdigit():
+            return float(value)
+        value = re.sub(r"[-.]", "/", value)
+        for fmt in ("%Y/%m/%d", "%m/%d/%Y"):
+            try:
+                return datetime.datetime.strptime(value, fmt).timestamp()
+            except ValueError:
+                pass
+        raise UnsupportedQueryError(f"Unparseable date {value!r}")
+
+
+class GmailQuery:
+    """
+    Parser for the subset of Gmail search syntax built by :code:`QueryAction`: :code:`key:value`
+    terms, bare and quoted words, negation with :code:`-`, :code:`OR`, :code:`{}` groups (any
+    term may match), and :code:`()` groups (all terms must match). Adjacent terms must all match.
+    """
+
+    tokenizer = re.compile(r'\s*([{}()]|-?(?:\w+:)?"[^"]*"|[^\s{}()]+)')
+
+    def __init__(self, query):
+        self.query = query
+        self.tokens = self.tokenizer.findall(query)
+
+    def parse(self):
+        """Returns the query as a tree of :code:`("and" | "or", [children])`, :code:`("not", child)`, and :code:`("term", key, value)` tuples"""
+        tree = self._and(close=None)
+        if self.tokens:
+            raise UnsupportedQueryError(f"Unbalanced brackets in {self.query!r}")
+        return tree
+
+    def _and(self, close):
+        terms = []
+        while self.tokens and self.tokens[0] != close:
+            terms.append(self._or())
+        if close is not None:
+            if not self.tokens:
+                raise UnsupportedQueryError(f"Unclosed {close!r} in {self.query!r}")
+            self.tokens.pop(0)
+        return ("and", terms)
+
+    def _or(self):
+        terms = [self._atom()]
+        while self.tokens and self.tokens[0] == "OR":
+            self.tokens.pop(0)
+            terms.append(self._atom())
+        return terms[0] if len(terms) == 1 else ("or", terms)
+
+    def _atom(self):
+        if not self.tokens:
+            raise UnsupportedQueryError(f"Dangling operator in {self.query!r}")
+        token = self.tokens.pop(0)
+        # Negated group, such as -{from:a from:b}
+        if token == "-":
+            if not self.tokens or self.tokens[0] not in ("{", "("):
+                raise UnsupportedQueryError(f"Dangling '-' in {self.query!r}")
+            return ("not", self._atom())
+        if token == "{":
+            terms = []
+            while self.tokens and self.tokens[0] != "}":
+                if self.tokens[0] == "OR":
+                    self.tokens.pop(0)
+                else:
+                    terms.append(self._atom())
+            if not self.tokens:
+                raise UnsupportedQueryError(f"Unclosed '{{' in {self.query!r}")
+            self.tokens.pop(0)
+            return ("or", terms)
+        if token == "(":
+            return self._and(close=")")
+        if token in ("}", ")"):
+            raise UnsupportedQueryError(f"Unbalanced brackets in {self.query!r}")
+        if token.startswith("-") and len(token) > 1:
+            return ("not", self._term(token[1:]))
+        return self._term(token)
+
+    @staticmethod
+    def _term(token):
+        key, _, value = (
+            token.partition(":") if ":" in token.split('"')[0] else ("", "", token)
+        )
+        return ("term", key.lower() or None, value.strip('"'))
+
+
+class UnsupportedQueryError(Exception):
+    """Raised if a search query cannot be evaluated against the local store"""
+
+
 class InvalidPathError(Exception):
     """Raises exception if a path does not exist, or user lacks write permission"""
 
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 import argparse as ap
 import json
+import os
 import sys
 
 from Gmailtools import classes
@@ -91,14 +92,284 @@ def assign_label():
 
 
 def mark_read():
+    parser = ap.ArgumentParser(
+        description="""Mark all unread emails in the inbox read"""
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="""Count unread emails without marking them read""",
+    )
+    args = vars(parser.parse_args())
+
     gmail_service = utils.authenticate()
-    response = utils.page_response(gmail_service, q="in:inbox is:unread")
+    # Listed in full first, since marking messages read removes them from the
+    # results still being paged through
+    ids = [
+        message["id"]
+        for message in utils.page_response(
+            gmail_service, max_emails=None, userId="me", q="in:inbox is:unread"
+        )
+    ]
+    if args["dry_run"]:
+        print(f"{len(ids)} unread email(s) in inbox")
+        return
+    n = utils.batch_modify(gmail_service, ids, remove_labels=["UNREAD"])
+    print(f"All emails marked read ({n})")
+
 
-    for message in response:
-        gmail_service.users().messages().modify(
-            userId="me", id=message["id"], body={"removeLabelIds": ["UNREAD"]}
-        ).execute()
-    print("All emails marked read")
+def bulk():
+    parser = ap.ArgumentParser(
+        description="""Apply label changes, archive, or trash all emails matching search parameters"""
+    )
+    add_search_arguments(parser)
+    # Unlike query_emails, act on every match unless limited
+    parser.set_defaults(max_emails=None)
+    actions = parser.add_argument_group("Actions")
+    actions.add_argument(
+        "--add_label", nargs="+", default=[], help="""Names of labels to add"""
+    )
+    actions.add_argument(
+        "--remove_label", nargs="+", default=[], help="""Names of labels to remove"""
+    )
+    actions.add_argument(
+        "--archive", action="store_true", help="""Remove emails from the inbox"""
+    )
+    actions.add_argument(
+        "--trash", action="store_true", help="""Move emails to trash"""
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="""Count matching emails without changing them""",
+    )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        help="""Number of threads to send requests with. Defaults to sending them one at a time.""",
+    )
+    parser.add_argument(
+        "--rate",
+        type=positive_float,
+        help="""Maximum number of requests per second""",
+    )
+    args = vars(parser.parse_args())
+    options = {
+        k: args.pop(k)
+        for k in (
+            "add_label",
+            "remove_label",
+            "archive",
+            "trash",
+            "dry_run",
+            "workers",
+            "rate",
+        )
+    }
+    max_emails = args.pop("max_emails")
+    request = utils.build_query(args)
+
+    if not (
+        options["add_label"]
+        or options["remove_label"]
+        or options["archive"]
+        or options["trash"]
+        or options["dry_run"]
+    ):
+        parser.error("No action specified")
+
+    gmail_service = utils.authenticate()
+    # Listed in full first, since trashing, archiving or relabelling messages can
+    # remove them from the results still being paged through
+    ids = [
+        message["id"]
+        for message in utils.page_response(
+            gmail_service, max_emails=max_emails, userId="me", q=request
+        )
+    ]
+    if options["dry_run"]:
+        print(f"{len(ids)} email(s) match query {request!r}")
+        return
+
+    mapping = utils.label_decode(gmail_service, id_key=False)
+    try:
+        add_labels = [mapping[x] for x in options["add_label"]]
+        remove_labels = [mapping[x] for x in options["remove_label"]]
+    except KeyError as e:
+        print(f"No label named {e}")
+        sys.exit()
+    if options["trash"]:
+        add_labels.append("TRASH")
+    if options["archive"]:
+        remove_labels.append("INBOX")
+    n = utils.batch_modify(
+        gmail_service,
+        ids,
+        add_labels=add_labels,
+        remove_labels=remove_labels,
+        workers=options["workers"],
+        rate=options["rate"],
+    )
+    print(f"Modified {n} email(s)")
+
+
+def sync():
+    parser = ap.ArgumentParser(
+        description="""Mirror a mailbox, or the messages with a given label, into a local store"""
+    )
+    parser.add_argument(
+        "-l",
+        "--label",
+        help="""Name of a label to restrict the sync to. Changing the label replaces the stored messages.""",
+    )
+    parser.add_argument(
+        "--store",
+        default=constants.STORE_PATH,
+        help=f"""Path to the local store, defaults to {constants.STORE_PATH}""",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="""Relist the whole mailbox instead of applying changes since the last sync""",
+    )
+    parser.add_argument(
+        "--workers",
+        type=positive_int,
+        help="""Number of threads to fetch messages with""",
+    )
+    args = vars(parser.parse_args())
+
+    gmail_service = utils.authenticate()
+    label_id = None
+    if args["label"] is not None:
+        try:
+            label_id = utils.label_decode(gmail_service, id_key=False)[args["label"]]
+        except KeyError:
+            print(f"No label named {args['label']!r}")
+            sys.exit()
+    with classes.LocalStore(utils.normalize_path(args["store"])) as store:
+        counts = utils.sync_mailbox(
+            gmail_service,
+            store,
+            label_id=label_id,
+            workers=args["workers"],
+            full=args["full"],
+        )
+    print(
+        f"Synced {args['store']}: {counts['added']} added, {counts['deleted']} deleted, {counts['relabelled']} relabelled"
+    )
+
+
+def positive_int(value):
+    """Argument type accepting only integers greater than zero"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise ap.ArgumentTypeError(f"invalid int value: {value!r}")
+    if number < 1:
+        raise ap.ArgumentTypeError(f"must be a positive integer, not {value!r}")
+    return number
+
+
+def positive_float(value):
+    """Argument type accepting only numbers greater than zero"""
+    try:
+        number = float(value)
+    except ValueError:
+        raise ap.ArgumentTypeError(f"invalid float value: {value!r}")
+    if not number > 0:
+        raise ap.ArgumentTypeError(f"must be a positive number, not {value!r}")
+    return number
+
+
+def add_search_arguments(parser):
+    """Adds email search flags, which :code:`utils.build_query` turns into a Gmail query, to a parser"""
+    parser.add_argument(
+        "-f",
+        "--from",
+        action=classes.QueryAction,
+        nargs="*",
+        help="""Senders to query for""",
+    )
+    parser.add_argument(
+        "-t",
+        "--to",
+        action=classes.QueryAction,
+        nargs="*",
+        help="""Receivers to query for""",
+    )
+    parser.add_argument(
+        "-w",
+        "--word",
+        action=classes.QueryAction,
+        nargs="*",
+        help="""Words to query for""",
+    )
+    parser.add_argument(
+        "-l",
+        "--label",
+        action=classes.QueryAction,
+        nargs="*",
+        help="""Labels to query for""",
+    )
+    parser.add_argument(
+        "-s",
+        "--subject",
+        action=classes.QueryAction,
+        nargs="*",
+        help="""Words in the subject line to query for""",
+    )
+    parser.add_argument(
+        "--filename",
+        action=classes.QueryAction,
+        nargs="?",
+        help="""Attachment file name or extension to search for""",
+    )
+    parser.add_argument(
+        "-b",
+        "--before",
+        action=classes.QueryAction,
+        nargs="?",
+        help="""Date before (as YYYY/DD/MM or MM/DD/YYYY)""",
+    )
+    parser.add_argument(
+        "-a",
+        "--after",
+        action=classes.QueryAction,
+        nargs="?",
+        help="""Date after (as YYYY/DD/MM or MM/DD/YYYY)""",
+    )
+    parser.add_argument(
+        "-c",
+        "--category",
+        action=classes.QueryAction,
+        nargs="?",
+        help="""Email category""",
+    )
+    parser.add_argument(
+        "-i",
+        "--ids",
+        action=classes.QueryAction,
+        nargs="*",
+        help="""RFC message IDs to include""",
+    )
+    parser.add_argument(
+        "-e",
+        "--extra",
+        nargs="?",
+        help="""Additional query (quoted) to append to search""",
+    )
+    parser.add_argument(
+        "-m",
+        "--max_emails",
+        nargs="?",
+        help="Maximum number of emails to return, or 'all' to stream every matching email",
+        default=500,
+        action=classes.MaxAction,
+    )
+    parser.add_argument(
+        "-o", "--or", action="store_true", help="""Use OR instead of AND combinator"""
+    )
 
 
 # Configure for plaintext decoding
@@ -119,9 +390,6 @@ def query_emails(new_args=None, prev_args=None):
     from Gmailtools import utils
     from os.path import abspath
 
-    # Configure for plaintext decoding
-    gmail_service = utils.authenticate()
-
     parser = ap.ArgumentParser(
         description="""Specify email search parameters""", add_help=False
     )
@@ -174,10 +442,54 @@ def query_emails(new_args=None, prev_args=None):
         help="Overwrite existing files with the same names as download attachments",
         action="store_true",
     )
+    parser_download.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Keep attachments in a content-addressed store and link them into the download directory, never downloading stored attachments again",
+    )
+    parser_download.add_argument(
+        "--attachment_store",
+        default=constants.ATTACHMENT_STORE_PATH,
+        help=f"Directory of the attachment store used by --dedup. Defaults to {constants.ATTACHMENT_STORE_PATH}.",
+    )
+    parser_download.add_argument(
+        "--buffer_size",
+        type=positive_int,
+        default=constants.DOWNLOAD_BUFFER_SIZE,
+        help=f"Number of bytes of each attachment to decode and write at a time. Defaults to {constants.DOWNLOAD_BUFFER_SIZE}.",
+    )
     parser_store.add_argument(
         "--output",
-        type=ap.FileType("w+", errors="replace"),
-        help="Output file to write to",
+        help=f"Output file to write to, or - for standard output. Defaults to {constants.STORE_OUTPUT}.json, .ndjson, or .parquet, by --format, in the working directory.",
+    )
+    parser_store.add_argument(
+        "--format",
+        choices=("json", "ndjson", "parquet"),
+        default="json",
+        help="""Write a JSON object keyed by message ID (json), one JSON object per line (ndjson), or a Parquet table (parquet, requires pyarrow), written as messages are parsed. Defaults to json.""",
+    )
+    parser_store.add_argument(
+        "--row_group_size",
+        type=positive_int,
+        default=constants.PARQUET_ROW_GROUP_SIZE,
+        help=f"Number of messages per Parquet row group, buffered in memory before writing. Defaults to {constants.PARQUET_ROW_GROUP_SIZE}.",
+    )
+    parser_store.add_argument(
+        "--compression",
+        choices=("none", "snappy", "gzip", "brotli", "lz4", "zstd"),
+        default=constants.PARQUET_COMPRESSION,
+        help=f"Compression codec of Parquet output. Defaults to {constants.PARQUET_COMPRESSION}.",
+    )
+    parser_store.add_argument(
+        "--flush_every",
+        type=positive_int,
+        default=constants.FLUSH_EVERY,
+        help=f"Number of messages to write between flushes of the output file. Defaults to {constants.FLUSH_EVERY}.",
+    )
+    parser_store.add_argument(
+        "--append",
+        action="store_true",
+        help="""Append to an existing ndjson file instead of replacing it, skipping messages it already contains""",
     )
     parser_store.add_argument(
         "-v",
@@ -190,102 +502,45 @@ def query_emails(new_args=None, prev_args=None):
         action="store_true",
         help="""Await further input after printing emails""",
     )
+    for subparser in (parser_print, parser_store):
+        subparser.add_argument(
+            "--headers-only",
+            action="store_true",
+            help="""Fetch only sender, recipient, subject, date, and ID, omitting bodies and attachments""",
+        )
 
     search_args_parser = ap.ArgumentParser(description="Search arguments")
+    add_search_arguments(search_args_parser)
     search_args_parser.add_argument(
-        "-f",
-        "--from",
-        action=classes.QueryAction,
-        nargs="*",
-        help="""Senders to query for""",
-    )
-    search_args_parser.add_argument(
-        "-t",
-        "--to",
-        action=classes.QueryAction,
-        nargs="*",
-        help="""Receivers to query for""",
-    )
-    search_args_parser.add_argument(
-        "-w",
-        "--word",
-        action=classes.QueryAction,
-        nargs="*",
-        help="""Words to query for""",
+        "--workers",
+        type=positive_int,
+        help="""Number of threads to fetch messages and download attachments with. Defaults to fetching messages in batches and downloading attachments one at a time.""",
     )
     search_args_parser.add_argument(
-        "-l",
-        "--label",
-        action=classes.QueryAction,
-        nargs="*",
-        help="""Labels to query for""",
+        "--processes",
+        type=positive_int,
+        help="""Number of processes to decode message bodies and convert HTML with. Defaults to decoding on the main thread.""",
     )
     search_args_parser.add_argument(
-        "-s",
-        "--subject",
-        action=classes.QueryAction,
-        nargs="*",
-        help="""Words in the subject line to query for""",
-    )
-    search_args_parser.add_argument(
-        "--filename",
-        action=classes.QueryAction,
-        nargs="?",
-        help="""Attachment file name or extension to search for""",
-    )
-    search_args_parser.add_argument(
-        "-b",
-        "--before",
-        action=classes.QueryAction,
-        nargs="?",
-        help="""Date before (as YYYY/DD/MM or MM/DD/YYYY)""",
-    )
-    search_args_parser.add_argument(
-        "-a",
-        "--after",
-        action=classes.QueryAction,
-        nargs="?",
-        help="""Date after (as YYYY/DD/MM or MM/DD/YYYY)""",
-    )
-    search_args_parser.add_argument(
-        "-c",
-        "--category",
-        action=classes.QueryAction,
-        nargs="?",
-        help="""Email category""",
-    )
-    search_args_parser.add_argument(
-        "-i",
-        "--ids",
-        action=classes.QueryAction,
-        nargs="*",
-        help="""RFC message IDs to include""",
-    )
-    search_args_parser.add_argument(
-        "-e",
-        "--extra",
-        nargs="?",
-        help="""Additional query (quoted) to append to search""",
+        "--no-cache",
+        action="store_true",
+        help="""Neither read from nor write to the local message cache""",
     )
-    # 500 is API max
     search_args_parser.add_argument(
-        "-m",
-        "--max_emails",
-        type=int,
-        nargs="?",
-        help="Maximum number of emails to return",
-        default=500,
-        action=classes.MaxAction,
+        "--store",
+        default=constants.STORE_PATH,
+        help=f"""Path to the local store synced by gmail_sync, defaults to {constants.STORE_PATH}""",
     )
-
     search_args_parser.add_argument(
-        "-o", "--or", action="store_true", help="""Use OR instead of AND combinator"""
+        "--refresh",
+        action="store_true",
+        help="""Fetch every message from the API, replacing any cached copies""",
     )
     parser.add_argument(
         "-h", "--help", action="store_true", help="Print this help message and exit"
     )
     # breakpoint()
-    if new_args:
+    if new_args is not None:
         sub_args, search_args = parser.parse_known_args(new_args)
     else:
         sub_args, search_args = parser.parse_known_args()
@@ -312,4 +567,50 @@ def query_emails(new_args=None, prev_args=None):
         sub_args["subcommand"], sub_args["subcommand"]
     )
 
+    if sub_args.get("append") and sub_args["format"] != "ndjson":
+        print("--append requires --format ndjson")
+        sys.exit(2)
+    if sub_args.get("format") == "parquet" and sub_args["output"] == "-":
+        print("--format parquet cannot be written to standard output")
+        sys.exit(2)
+
+    # Authenticate only once arguments are known to be valid
+    gmail_service = utils.authenticate()
     sub_args["func"](gmail_service, search_args, sub_args)
+
+
+def daemon():
+    parser = ap.ArgumentParser(
+        description="""Serve gmail_query_emails requests from gmail_client over a Unix domain socket, keeping the authenticated client and message cache warm between them"""
+    )
+    parser.add_argument(
+        "--socket",
+        default=constants.DAEMON_SOCKET,
+        help=f"""Path of the socket, defaults to {constants.DAEMON_SOCKET}. gmail_client connects to the path in the GMAILTOOLS_SOCKET environment variable.""",
+    )
+    args = vars(parser.parse_args())
+    utils.serve_queries(os.path.abspath(utils.normalize_path(args["socket"])))
+
+
+def client():
+    """Runs gmail_query_emails with the given arguments in a running gmail_daemon, or in
+    this process if no daemon is listening"""
+    import socket
+
+    args = sys.argv[1:]
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(constants.DAEMON_SOCKET)
+    except (AttributeError, OSError):
+        query_emails(new_args=args)
+        return
+    with connection, connection.makefile("rw", encoding="UTF-8") as stream:
+        stream.write(json.dumps({"args": args, "cwd": os.getcwd()}) + "\n")
+        stream.flush()
+        for line in stream:
+            frame = json.loads(line)
+            if "exit" in frame:
+                sys.exit(frame["exit"])
+            for key, text in frame.items():
+                getattr(sys, key).write(text)
+    sys.exit("gmail_daemon closed the connection")
@@ -1,10 +1,14 @@
-import html2text
+import os
 
-# html2tex config
-html_decoder = html2text.HTML2Text()
-# html_decoder.ignore_links = True
-html_decoder.ignore_images = True
-html_decoder.body_width = 80
+# html2text config, applied when the decoder is first used
+HTML2TEXT_OPTIONS = {
+    # "ignore_links": True,
+    "ignore_images": True,
+    "body_width": 80,
+}
+# Converter of HTML message bodies to text: "html2text" (Markdown-like output) or "fast"
+# (a plain-text extractor built on the standard library's HTML parser)
+HTML_BACKEND = os.environ.get("GMAILTOOLS_HTML_BACKEND", "html2text")
 
 # Default list of Gmail auth scopes - better to use just one
 SCOPES = [
@@ -16,8 +20,114 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.compose",
 ]
 
+# Message headers extracted from each message, keyed to ParsedMessage fields
+HEADER_FIELDS = {
+    "Delivered-To": "recipient",
+    "From": "sender",
+    "Subject": "subject",
+    "Date": "date",
+    "Message-ID": "id",
+}
+
 SUBCOMMAND_ALIASES = {
     "dl": "download_attachments",
     "pe": "print_emails",
     "se": "store_emails",
 }
+
+# Maximum number of messages a single list response can contain
+PAGE_SIZE = 500
+
+# Gmail accepts up to 100 calls per batch, but recommends no more than 50 to
+# avoid rate limiting
+BATCH_SIZE = 50
+
+# Number of messages sent to a worker process at a time by --processes. Sending and
+# returning each chunk costs about as much as decoding with html2text, so chunks are
+# large enough to amortize it (see benchmarks/parse_processes.py).
+PARSE_CHUNK_SIZE = 50
+
+# Maximum number of message IDs accepted by a batchModify or batchDelete call
+MODIFY_BATCH_SIZE = 1000
+
+# Retry policy for failed API calls
+MAX_RETRIES = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF = 1
+
+# Local message cache
+CACHE_PATH = os.path.expanduser(
+    os.environ.get("GMAILTOOLS_CACHE", "~/.cache/Gmailtools/messages.sqlite")
+)
+DISCOVERY_CACHE_PATH = os.path.expanduser(
+    os.environ.get("GMAILTOOLS_DISCOVERY_CACHE", "~/.cache/Gmailtools/discovery")
+)
+# Seconds for which a cached discovery document is used
+DISCOVERY_CACHE_MAX_AGE = 24 * 60 * 60
+CACHE_MAX_BYTES = int(os.environ.get("GMAILTOOLS_CACHE_SIZE", 512 * 1024**2))
+# Incremented whenever the serialized form of ParsedMessage changes
+CACHE_VERSION = 2
+
+# Local mailbox mirror maintained by gmail_sync
+STORE_PATH = os.path.expanduser(
+    os.environ.get("GMAILTOOLS_STORE", "~/.local/share/Gmailtools/mailbox.sqlite")
+)
+
+# Seconds after a sync for which queries are answered from the local store
+STORE_MAX_AGE = int(os.environ.get("GMAILTOOLS_STORE_MAX_AGE", 3600))
+
+# Seconds before expiry at which a saved access token is refreshed
+TOKEN_REFRESH_MARGIN = int(os.environ.get("GMAILTOOLS_TOKEN_MARGIN", 300))
+
+# Unix domain socket on which gmail_daemon serves queries
+DAEMON_SOCKET = os.path.expanduser(
+    os.environ.get(
+        "GMAILTOOLS_SOCKET",
+        os.path.join(
+            os.environ.get("XDG_RUNTIME_DIR", "~/.cache/Gmailtools"), "Gmailtools.sock"
+        ),
+    )
+)
+
+# HTTP transport of API clients: "httplib2" (one connection per thread), "requests"
+# (a shared urllib3 connection pool), or "httpx" (a shared pool using HTTP/2 if h2 is installed)
+TRANSPORT = os.environ.get("GMAILTOOLS_TRANSPORT", "httplib2")
+# Maximum number of connections kept alive by the requests and httpx transports
+POOL_SIZE = int(os.environ.get("GMAILTOOLS_POOL_SIZE", 10))
+# Print connection reuse statistics of the transport after each query
+DEBUG_TRANSPORT = bool(os.environ.get("GMAILTOOLS_DEBUG_TRANSPORT"))
+
+# Bytes of base64 attachment data decoded and written at a time
+DOWNLOAD_BUFFER_SIZE = 1024**2
+
+# Output file of store_emails if none is given, completed with the extension of its format
+STORE_OUTPUT = "emails"
+
+# Number of messages store_emails writes between flushes of its output file
+FLUSH_EVERY = 100
+
+# Messages per row group, and compression codec, of store_emails --format parquet
+PARQUET_ROW_GROUP_SIZE = 1000
+PARQUET_COMPRESSION = "snappy"
+
+# Content-addressed store of downloaded attachments
+ATTACHMENT_STORE_PATH = os.path.expanduser(
+    os.environ.get("GMAILTOOLS_ATTACHMENTS", "~/.local/share/Gmailtools/attachments")
+)
+
+# Partial-response field masks declared for each API call, keyed by method
+FIELD_MASKS = {
+    "messages.list": "messages(id),nextPageToken",
+    "messages.get": "id,labelIds,sizeEstimate,payload",
+    "messages.get.metadata": "id,labelIds,sizeEstimate,payload/headers",
+    "messages.get.minimal": "id,labelIds",
+    "attachments.get": "data",
+    "labels.list": "labels(id,name)",
+    "filters.list": "filter(id,criteria,action)",
+    "history.list": "history(messagesAdded/message/id,messagesDeleted/message/id,"
+    "labelsAdded/message/id,labelsRemoved/message/id),"
+    "nextPageToken,historyId",
+    "getProfile": "historyId",
+}
+# Log the response bytes each field mask saves. Doubles the number of requests.
+DEBUG_FIELDS = bool(os.environ.get("GMAILTOOLS_DEBUG_FIELDS"))
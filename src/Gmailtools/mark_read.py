@@ -3,11 +3,12 @@ from Gmailtools import utils
 
 utils.set_wd_to_file(__file__)
 gmail_service = utils.authenticate()
-response = utils.page_response(gmail_service, q="in:inbox is:unread")
+response = utils.page_response(
+    gmail_service, max_emails=None, userId="me", q="in:inbox is:unread"
+)
+# Listed in full first, since marking messages read removes them from the results
+# still being paged through
 ids = [message["id"] for message in response]
 
-for ID in ids:
-    gmail_service.users().messages().modify(
-        userId="me", id=ID, body={"removeLabelIds": ["UNREAD"]}
-    ).execute()
+utils.batch_modify(gmail_service, ids, remove_labels=["UNREAD"])
 print("All emails marked read")
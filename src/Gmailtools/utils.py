@@ -3,24 +3,102 @@ import datetime
 import email
 import json
 import mimetypes
+import multiprocessing
 import os
+import sys
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from functools import reduce
-from io import TextIOWrapper
-from sys import exit
+from itertools import chain, islice
+from sys import exit, stderr
 
 from Gmailtools import classes
 from Gmailtools import command
 from Gmailtools import constants
-from google.auth.transport.requests import Request
-from google.oauth2 import service_account
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from requests.models import HTTPError
+
+# Google and HTML libraries are imported where used, so that argument parsing and
+# help do not pay for loading them
+
+# Services built by authenticate, keyed by its arguments
+_services = {}
+# Message cache kept open by serve_queries and shared by the requests it handles
+_daemon_cache = None
+# Shared transports of the requests and httpx kinds, keyed by credentials
+_transports = {}
+# Credentials of each client made by build_service
+_credentials = weakref.WeakKeyDictionary()
+
+
+def build_service(credentials):
+    """Builds a Gmail API client from the discovery document bundled with the client library,
+    or, on versions without bundled documents, from a discovery document cached on disk.
+    The client uses the HTTP transport named by :code:`constants.TRANSPORT`."""
+    from googleapiclient.discovery import build
+
+    if constants.TRANSPORT == "httplib2":
+        auth = {"credentials": credentials}
+    else:
+        auth = {"http": shared_transport(credentials)}
+    try:
+        service = build("gmail", "v1", static_discovery=True, **auth)
+    except TypeError:
+        # static_discovery was added in google-api-python-client 2.0
+        service = build("gmail", "v1", cache=classes.DiscoveryCache(), **auth)
+    _credentials[service] = credentials
+    return service
+
+
+def service_credentials(gmail_service):
+    """
+    Returns the credentials a client made by :code:`build_service` was built with, so that worker threads
+    can authorize connections of their own.
+
+    :raises ValueError: Raised if the client was not made by :code:`build_service`.
+    """
+    try:
+        return _credentials[gmail_service]
+    except KeyError:
+        raise ValueError(
+            "Client was not made by build_service, so its credentials are unknown"
+        ) from None
+
+
+def shared_transport(credentials):
+    """Returns the transport of kind :code:`constants.TRANSPORT` shared by all threads using :code:`credentials`, creating it on first use"""
+    kinds = {"requests": classes.RequestsTransport, "httpx": classes.HttpxTransport}
+    if constants.TRANSPORT not in kinds:
+        exit(
+            f"Unknown transport {constants.TRANSPORT!r}; choose from httplib2, {', '.join(kinds)}"
+        )
+    key = id(credentials)
+    if key not in _transports:
+        try:
+            _transports[key] = kinds[constants.TRANSPORT](credentials)
+        except ImportError as e:
+            exit(f"The {constants.TRANSPORT} transport requires {e.name}")
+    return _transports[key]
+
+
+def print_transport_stats():
+    """Prints the connection reuse statistics of each shared transport to stderr"""
+    if not _transports:
+        print("httplib2: connection statistics not tracked", file=stderr)
+    for transport in _transports.values():
+        print(transport.format(), file=stderr)
+
 
 # Largely copied from Google's quickstart guide
 
@@ -46,30 +124,42 @@ def authenticate(
     :type credentials_path: str, optional
     :param write_token: Indicates whether to save an authorization token for future use to :code:`token_path` if it does not already exist, default False.
     :type write_token: bool
+
+    The client is reused by later calls with the same arguments in the same process. Saved tokens are
+    refreshed shortly before they expire and written back to :code:`token_path` (see :code:`classes.TokenCache`).
     """
-    creds = None
+    key = (tuple(scopes), token_path, credentials_path)
+    if key in _services:
+        service = _services[key]
+        # Keep long-lived clients' tokens fresh and persisted
+        creds = service_credentials(service)
+        if creds.refresh_token and os.path.exists(token_path):
+            fresh = classes.TokenCache(token_path, scopes).refresh(creds)
+            # Update in place, since HTTP objects are keyed by credentials
+            creds.token, creds.expiry = fresh.token, fresh.expiry
+        return service
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
     os.environ["OAUTHLIB_RELAX_TOKEN_SCOPE"] = "1"
-    if os.path.exists(token_path):
-        creds = Credentials.from_authorized_user_file(token_path, scopes)
+    token_cache = classes.TokenCache(token_path, scopes)
+    creds = token_cache.load()
+    if creds and creds.refresh_token:
+        creds = token_cache.refresh(creds)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            if not os.path.exists(credentials_path):
-                raise IOError(f"{credentials_path} does not exist")
-            flow = InstalledAppFlow.from_client_secrets_file(
-                credentials_path, scopes=None
-            )  # changed to None
-            creds = flow.run_local_server(port=0)
+        if not os.path.exists(credentials_path):
+            raise IOError(f"{credentials_path} does not exist")
+        flow = InstalledAppFlow.from_client_secrets_file(
+            credentials_path, scopes=None
+        )  # changed to None
+        creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
         if write_token and not os.path.exists(token_path):
             try:
-                with open(token_path, "w") as token:
-                    token.write(creds.to_json())
+                token_cache.save(creds)
             except Exception as e:
                 print(f"Error writing token: {e}")
-    service = build("gmail", "v1", credentials=creds)
+    service = _services[key] = build_service(creds)
     return service
 
 
@@ -79,13 +169,15 @@ def service_authenticate(service_path, email):
     # workspace, which AU is, but
     # I can't log in to the
     # GOogle Admin console to enable it.
+    from google.oauth2 import service_account
+
     credentials = service_account.Credentials.from_service_account_file(
         service_path, scopes=constants.SCOPES
     )
     credentials = credentials.with_subject(
         email
     )  # Authorize for specific email address
-    service = build("gmail", "v1", credentials=credentials)
+    service = build_service(credentials)
     return service
 
 
@@ -95,14 +187,50 @@ def set_wd_to_file(file):
     os.chdir(os.path.dirname(current_wd))
 
 
+def api_request(method, name, **kwargs):
+    """
+    Builds an API request, restricting the response to the partial-response field mask declared for
+    the call in :code:`constants.FIELD_MASKS` unless :code:`fields` is passed. If :code:`constants.DEBUG_FIELDS`
+    is set, the unmasked response is also retrieved when the request is executed, and the bytes saved are logged.
+
+    :param method: Unbound API method, such as :code:`gmail_service.users().messages().list`
+    :type method: function
+    :param name: Key of the field mask in :code:`constants.FIELD_MASKS`
+    :type name: str
+    """
+    kwargs.setdefault("fields", constants.FIELD_MASKS.get(name))
+    request = method(**kwargs)
+    if constants.DEBUG_FIELDS:
+        full = method(**{k: v for k, v in kwargs.items() if k != "fields"})
+        # Return raw response bytes instead of parsed JSON
+        full.postproc = lambda resp, content: content
+        postproc = request.postproc
+
+        def log_savings(resp, content):
+            unmasked = len(full.execute(http=thread_http(request.http.credentials)))
+            print(
+                f"{name}: {len(content)} bytes with fields={kwargs['fields']!r}, "
+                f"{unmasked} without ({unmasked - len(content)} saved)",
+                file=stderr,
+            )
+            return postproc(resp, content)
+
+        request.postproc = log_savings
+    return request
+
+
 def list_filters(service):
     """List all filters active in a user account"""
-    return service.users().settings().filters().list(userId="me").execute()
+    return api_request(
+        service.users().settings().filters().list, "filters.list", userId="me"
+    ).execute()
 
 
 def label_decode(service, id_key=True):
     """Get a mapping of label IDs to names (the user-facing label names)"""
-    labels = service.users().labels().list(userId="me").execute()["labels"]
+    labels = api_request(
+        service.users().labels().list, "labels.list", userId="me"
+    ).execute()["labels"]
     # Ensure correct key-value order (defaults to ID as key)
     k, v = ("id", "name") if id_key else ("name", "id")
     return {label[k]: label[v] for label in labels}
@@ -110,6 +238,8 @@ def label_decode(service, id_key=True):
 
 def delete_label(service, label_id):
     """Delete a label from its ID"""
+    from requests.models import HTTPError
+
     try:
         service.users().labels().delete(userId="me", id=label_id).execute()
     except HTTPError as e:
@@ -146,20 +276,414 @@ def validate_before_present(date_string, formats):
 
 def get_message(gmail_service, userId="me", **kwargs):
     """Retrieve a message given a user ID and message ID"""
-    return gmail_service.users().messages().list(userId=userId, **kwargs).execute()
+    return api_request(
+        gmail_service.users().messages().list, "messages.list", userId=userId, **kwargs
+    ).execute()
 
 
-def parse_message(gmail_service, messages):
-    """Traverse message to extract sender, recipient, date, and text"""
+def unique_messages(messages):
+    """Yields messages in order, skipping any with the same Message-ID as an earlier one"""
+    seen = set()
     for message in messages:
-        header = extract_header(message["headers"])
-        parsed = extract_fields(gmail_service, message=message, message_id=header["id"])
-        yield {**header, **parsed}
+        if message.id not in seen:
+            seen.add(message.id)
+            yield message
+
+
+def chunked(iterable, size):
+    """Split an iterable into lists of at most :code:`size` elements"""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def is_retryable(exception):
+    """Determine whether a failed API call is worth retrying (rate limits and server errors)"""
+    from googleapiclient.errors import HttpError
+
+    return (
+        isinstance(exception, HttpError)
+        and exception.resp.status in constants.RETRY_STATUSES
+    )
+
+
+def batch_get_messages(
+    gmail_service,
+    ids,
+    batch_size=constants.BATCH_SIZE,
+    max_retries=constants.MAX_RETRIES,
+    userId="me",
+    **kwargs,
+):
+    """
+    Retrieves messages using batch HTTP requests, sending up to :code:`batch_size`
+    :code:`messages.get` calls in a single round trip. Calls that fail with a rate limit
+    or server error are retried with exponential backoff; other failures are reported and skipped.
+    Messages are yielded in the same order as :code:`ids`.
+
+    :param gmail_service: Gmail API client object
+    :type gmail_service: googleapiclient.discovery.Resource
+    :param ids: Gmail message IDs to retrieve
+    :type ids: Iterable[str]
+    :param batch_size: Maximum number of calls per batch request, defaults to :code:`constants.BATCH_SIZE`
+    :type batch_size: int, optional
+    :param max_retries: Maximum number of times to retry failed calls in each batch, defaults to :code:`constants.MAX_RETRIES`
+    :type max_retries: int, optional
+    """
+    for chunk in chunked(ids, batch_size):
+        results = {}
+        pending = dict(enumerate(chunk))
+        for attempt in range(max_retries + 1):
+            errors = {}
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    results[int(request_id)] = response
+                else:
+                    errors[int(request_id)] = exception
+
+            batch = gmail_service.new_batch_http_request(callback=callback)
+            for i, message_id in pending.items():
+                batch.add(
+                    api_request(
+                        gmail_service.users().messages().get,
+                        "messages.get",
+                        userId=userId,
+                        id=message_id,
+                        **kwargs,
+                    ),
+                    request_id=str(i),
+                )
+            batch.execute()
+            pending = {}
+            for i, exception in errors.items():
+                if is_retryable(exception) and attempt < max_retries:
+                    pending[i] = chunk[i]
+                else:
+                    print(f"Error retrieving message {chunk[i]!r}: {exception}")
+            if not pending:
+                break
+            time.sleep(constants.RETRY_BACKOFF * 2**attempt)
+        yield from (results[i] for i in range(len(chunk)) if i in results)
+
+
+# httplib2.Http objects are not thread-safe, so each worker thread gets its own
+_thread_local = threading.local()
+
+
+def thread_http(credentials):
+    """Returns an authorized HTTP object private to the calling thread, creating it on first use.
+    The requests and httpx transports are thread-safe, so all threads share one."""
+    if constants.TRANSPORT != "httplib2":
+        return shared_transport(credentials)
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+
+    if getattr(_thread_local, "credentials", None) is not credentials:
+        _thread_local.credentials = credentials
+        _thread_local.http = AuthorizedHttp(credentials, http=httplib2.Http())
+    return _thread_local.http
+
+
+def get_attachment_data(gmail_service, message_id, attachment_id, http=None):
+    """Retrieve the base64-encoded data of an attachment"""
+    return api_request(
+        gmail_service.users().messages().attachments().get,
+        "attachments.get",
+        userId="me",
+        messageId=message_id,
+        id=attachment_id,
+    ).execute(http=http, num_retries=constants.MAX_RETRIES)["data"]
+
+
+def pooled_get_messages(
+    gmail_service, ids, workers, userId="me", executor=None, **kwargs
+):
+    """
+    Retrieves messages using a pool of worker threads, each with its own
+    HTTP connection. Messages are yielded as they finish, so the output order may differ from that of
+    :code:`ids`. Failed calls are retried with exponential backoff by the client library.
+
+    :param gmail_service: Gmail API client object
+    :type gmail_service: googleapiclient.discovery.Resource
+    :param ids: Gmail message IDs to retrieve
+    :type ids: Iterable[str]
+    :param workers: Number of worker threads
+    :type workers: int
+    :param executor: Thread pool to use, so that its threads and their connections can be reused across calls. Defaults to :code:`None`, which creates a pool of :code:`workers` threads for this call.
+    :type executor: concurrent.futures.ThreadPoolExecutor, optional
+    """
+    # Requests are built with the shared client but executed with per-thread connections
+    credentials = service_credentials(gmail_service)
+
+    def fetch(message_id):
+        return api_request(
+            gmail_service.users().messages().get,
+            "messages.get",
+            userId=userId,
+            id=message_id,
+            **kwargs,
+        ).execute(http=thread_http(credentials), num_retries=constants.MAX_RETRIES)
+
+    for message_id, future in pool_map(fetch, ids, workers, executor=executor):
+        try:
+            yield future.result()
+        except Exception as e:
+            print(f"Error retrieving message {message_id!r}: {e}")
 
 
-def extract_fields(gmail_service, message, message_id):
-    """Recurses through message parts until plain text part is discovered"""
+def pool_map(fn, items, workers, executor=None):
+    """Applies a function to each item on a pool of worker threads, yielding
+    :code:`(item, future)` pairs as calls finish. At most twice as many calls as workers
+    are in flight at once, so :code:`items` may be a long or lazy iterable. An existing
+    :code:`executor` of :code:`workers` threads may be passed; otherwise one is created for the call.
+    """
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from pool_map(fn, items, workers, executor)
+        return
+    items = iter(items)
+    futures = {executor.submit(fn, item): item for item in islice(items, 2 * workers)}
+    while futures:
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = futures.pop(future)
+            for next_item in islice(items, 1):
+                futures[executor.submit(fn, next_item)] = next_item
+            yield item, future
+
+
+def bulk_execute(
+    gmail_service,
+    ids,
+    make_request,
+    batch_size=constants.MODIFY_BATCH_SIZE,
+    workers=None,
+    rate=None,
+):
+    """
+    Executes a bulk API call, such as :code:`batchModify`, over chunks of message IDs, optionally on
+    several threads and at a limited rate. Failed calls are retried with exponential backoff.
+
+    :param gmail_service: Gmail API client object
+    :type gmail_service: googleapiclient.discovery.Resource
+    :param ids: Gmail message IDs
+    :type ids: Iterable[str]
+    :param make_request: Function of a list of IDs returning an unexecuted request
+    :type make_request: function
+    :param batch_size: Maximum number of IDs per call, defaults to :code:`constants.MODIFY_BATCH_SIZE` (the API maximum)
+    :type batch_size: int, optional
+    :param workers: Number of threads to send requests with, defaults to :code:`None` (the calling thread).
+    :type workers: int, optional
+    :param rate: Maximum number of requests per second, defaults to :code:`None` (unlimited).
+    :type rate: float, optional
+    :return: Number of messages affected
+    :rtype: int
+    """
+    limiter = classes.RateLimiter(rate) if rate else None
+
+    def run(chunk, http=None):
+        if limiter is not None:
+            limiter.wait()
+        make_request(chunk).execute(http=http, num_retries=constants.MAX_RETRIES)
+        return len(chunk)
+
+    chunks = chunked(ids, batch_size)
+    if not workers:
+        return sum(run(chunk) for chunk in chunks)
+    credentials = service_credentials(gmail_service)
+    return sum(
+        future.result()
+        for _, future in pool_map(
+            lambda chunk: run(chunk, http=thread_http(credentials)), chunks, workers
+        )
+    )
+
+
+def batch_modify(gmail_service, ids, add_labels=None, remove_labels=None, **kwargs):
+    """
+    Adds and removes labels on messages with :code:`batchModify`. Keyword arguments
+    are passed to :code:`bulk_execute`.
+
+    :param gmail_service: Gmail API client object
+    :type gmail_service: googleapiclient.discovery.Resource
+    :param ids: Gmail message IDs to modify
+    :type ids: Iterable[str]
+    :param add_labels: IDs of labels to add, defaults to None
+    :type add_labels: List[str], optional
+    :param remove_labels: IDs of labels to remove, defaults to None
+    :type remove_labels: List[str], optional
+    :return: Number of messages modified
+    :rtype: int
+    """
+    return bulk_execute(
+        gmail_service,
+        ids,
+        lambda chunk: gmail_service.users()
+        .messages()
+        .batchModify(
+            userId="me",
+            body={
+                "ids": chunk,
+                "addLabelIds": add_labels or [],
+                "removeLabelIds": remove_labels or [],
+            },
+        ),
+        **kwargs,
+    )
+
+
+def parse_message(
+    messages, executor=None, chunksize=constants.PARSE_CHUNK_SIZE, max_pending=4
+):
+    """
+    Traverse message resources to extract sender, recipient, date, text, and attachment handles.
+    Messages are yielded in the order given.
+
+    :param messages: Message resources
+    :type messages: Iterable[dict]
+    :param executor: Pool of processes to decode message bodies on, defaults to :code:`None` (the calling thread).
+    :type executor: concurrent.futures.ProcessPoolExecutor, optional
+    :param chunksize: Number of messages submitted to :code:`executor` at a time, defaults to :code:`constants.PARSE_CHUNK_SIZE`.
+    :type chunksize: int, optional
+    :param max_pending: Maximum number of chunks submitted to :code:`executor` but not yet yielded, defaults to 4.
+    :type max_pending: int, optional
+    """
+    if executor is None:
+        yield from map(parse_resource, messages)
+        return
+    chunks = chunked(messages, chunksize)
+    pending = deque(
+        executor.submit(parse_resources, chunk) for chunk in islice(chunks, max_pending)
+    )
+    while pending:
+        parsed = pending.popleft().result()
+        for chunk in islice(chunks, 1):
+            pending.append(executor.submit(parse_resources, chunk))
+        yield from parsed
+
+
+def parse_resource(message):
+    """Extracts the fields of one message resource"""
+    payload = message["payload"]
+    header = extract_header(payload["headers"])
+    # Metadata-only responses carry no body or parts
+    parsed = (
+        extract_fields(message=payload, message_id=message["id"])
+        if "body" in payload
+        else {"body": None, "attachments": {}}
+    )
+    return {
+        **header,
+        **parsed,
+        "gmail_id": message["id"],
+        "labels": message.get("labelIds", []),
+        "size": message.get("sizeEstimate"),
+    }
+
+
+def parse_resources(messages):
+    """Extracts the fields of a list of message resources. Run in worker processes by :code:`parse_message`."""
+    return [parse_resource(message) for message in messages]
+
+
+def process_pool(processes):
+    """
+    Returns a pool of :code:`processes` processes to decode message bodies on. Workers are started by a
+    fork server, or spawned where there is none, rather than forked from this process: fetch threads
+    may be running, and a forked child would inherit any locks they hold, such as those of httplib2 and SSL,
+    locked forever.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["Gmailtools.utils"])
+    else:
+        context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+
+def retrieve_messages(
+    gmail_service,
+    ids,
+    workers=None,
+    cache=None,
+    refresh=False,
+    headers_only=False,
+    processes=None,
+):
+    """
+    Retrieves and parses messages, serving those present in a :code:`MessageCache` from
+    it and fetching only the rest from the API. Fetched messages are added to the cache,
+    unless only their headers were fetched.
+
+    :param gmail_service: Gmail API client object
+    :type gmail_service: googleapiclient.discovery.Resource
+    :param ids: Gmail message IDs to retrieve
+    :type ids: Iterable[str]
+    :param workers: Number of threads to fetch messages with. Defaults to :code:`None`, which fetches in batches on the calling thread.
+    :type workers: int, optional
+    :param cache: Cache of previously parsed messages, defaults to :code:`None` (no caching).
+    :type cache: classes.MessageCache, optional
+    :param refresh: Whether to fetch every message from the API even if cached, defaults to False.
+    :type refresh: bool, optional
+    :param headers_only: Whether to fetch only the headers in :code:`constants.HEADER_FIELDS`, leaving message bodies and attachments empty. Defaults to False.
+    :type headers_only: bool, optional
+    :param processes: Number of processes to decode message bodies with, defaults to :code:`None` (the calling thread).
+    :type processes: int, optional
+    """
+    kwargs = (
+        {
+            "format": "metadata",
+            "metadataHeaders": list(constants.HEADER_FIELDS.keys()),
+            "fields": constants.FIELD_MASKS["messages.get.metadata"],
+        }
+        if headers_only
+        else {}
+    )
+
+    def fetch(ids):
+        fetched = (
+            pooled_get_messages(gmail_service, ids, workers, executor=threads, **kwargs)
+            if workers
+            else batch_get_messages(gmail_service, ids, **kwargs)
+        )
+        return (
+            classes.ParsedMessage(**mess)
+            for mess in parse_message(
+                fetched, executor=executor, max_pending=2 * (processes or 1)
+            )
+        )
+
+    # One thread pool serves every chunk, so its threads keep their connections
+    threads = ThreadPoolExecutor(max_workers=workers) if workers else None
+    # Headers need no decoding, so are not worth sending to other processes
+    executor = process_pool(processes) if processes and not headers_only else None
+    try:
+        if cache is None:
+            yield from fetch(ids)
+            return
+
+        for chunk in chunked(ids, constants.BATCH_SIZE):
+            cached = {} if refresh else cache.get_many(chunk)
+            for message in fetch([id for id in chunk if id not in cached]):
+                if not headers_only:
+                    cache.put(message)
+                cached[message.gmail_id] = message
+            yield from (cached[id] for id in chunk if id in cached)
+            cache.evict()
+    finally:
+        for pool in (threads, executor):
+            if pool is not None:
+                pool.shutdown()
+
+
+def extract_fields(message, message_id):
+    """Recurses through message parts to find the body and attachments. Attachments are
+    recorded as :code:`AttachmentHandle` objects; their content is only retrieved when read.
+    The body is taken from a text/plain part if there is one, since it needs only charset decoding,
+    and otherwise converted from a text/html part."""
     out = {"body": None, "attachments": {}}
+    bodies = {}
     # Based on https://stackoverflow.com/questions/25832631/download-attachments-from-gmail-using-gmail-api
     parts = [message]
     # breakpoint()
@@ -168,43 +692,61 @@ def extract_fields(gmail_service, message, message_id):
         if "multipart" in cur["mimeType"]:
             parts.extend(cur["parts"])
         if cur["body"].get("attachmentId"):
-            data = cur["body"].get(
-                "data",  # May need API request to retrieve data
-                (
-                    gmail_service.users()
-                    .messages()
-                    .attachments()
-                    .get(
-                        userId="me",
-                        messageId=message_id,
-                        id=cur["body"]["attachmentId"],
-                    )
-                    .execute()["data"]
-                ),
+            # Key attachments to names
+            out["attachments"][cur["filename"]] = classes.AttachmentHandle(
+                name=cur["filename"],
+                message_id=message_id,
+                attachment_id=cur["body"]["attachmentId"],
+                size=cur["body"].get("size"),
+                mime_type=cur["mimeType"],
+                data=cur["body"].get("data"),
             )
-            if data:
-                data = base64.urlsafe_b64decode(data.encode("UTF-8"))
-                # Key attachment data to names
-                out["attachments"][cur["filename"]] = data
         # Beware: attachments can be text/plain
-        elif cur["mimeType"] == "text/plain" and cur["body"].get(
-            "data"
-        ):  # vs text/html?
-            out["body"] = decode_message(cur["body"]["data"], constants.html_decoder)
+        elif cur["mimeType"] in ("text/plain", "text/html") and cur["body"].get("data"):
+            bodies[cur["mimeType"]] = cur
 
+    if "text/plain" in bodies:
+        out["body"] = decode_part(bodies["text/plain"])
+    elif "text/html" in bodies:
+        out["body"] = html_to_text(decode_part(bodies["text/html"]))
     return out
 
 
+def decode_part(part):
+    """Decodes the base64 data of a message part to text using the charset of its Content-Type header (UTF-8 if unstated or unknown)"""
+    data = base64.urlsafe_b64decode(part["body"]["data"].encode("ASCII"))
+    headers = email.message.Message()
+    for header in part.get("headers", []):
+        if header["name"].lower() == "content-type":
+            headers["Content-Type"] = header["value"]
+    charset = headers.get_content_charset() or "utf-8"
+    try:
+        return data.decode(charset, errors="replace")
+    except LookupError:
+        return data.decode("utf-8", errors="replace")
+
+
+def html_to_text(html, backend=None):
+    """
+    Converts an HTML message body to text.
+
+    :param html: HTML document
+    :type html: str
+    :param backend: Converter to use, "html2text" or "fast". Defaults to :code:`constants.HTML_BACKEND`.
+    :type backend: str, optional
+    """
+    backend = backend or constants.HTML_BACKEND
+    if backend == "fast":
+        return classes.HTMLTextExtractor.convert(html)
+    if backend == "html2text":
+        return html_decoder().handle(html)
+    raise ValueError(f"Unknown HTML backend {backend!r}; choose from html2text, fast")
+
+
 def extract_header(header, to_extract=None):
     """Extracts metadata fields from a message object"""
     if to_extract is None:
-        to_extract = {
-            "Delivered-To": "recipient",
-            "From": "sender",
-            "Subject": "subject",
-            "Date": "date",
-            "Message-ID": "id",
-        }
+        to_extract = constants.HEADER_FIELDS
     filtered = dict(zip(to_extract.values(), [None] * len(to_extract)))
     filtered = {
         **filtered,
@@ -215,36 +757,50 @@ def extract_header(header, to_extract=None):
         },
     }
     if filtered["id"] is None:
-        filtered[
-            "id"
-        ] = f"Unidentified (sent {filtered.get('date', 'Unidentified (date unknown)')!r})"
+        filtered["id"] = (
+            f"Unidentified (sent {filtered.get('date', 'Unidentified (date unknown)')!r})"
+        )
     return filtered
 
 
-# Largely taken from https://stackoverflow.com/questions/50630130/how-to-retrieve-the-whole-message-body-using-gmail-api-python
+def html_decoder():
+    """Returns an :code:`HTML2Text` object configured by :code:`constants.HTML2TEXT_OPTIONS`, creating it on first use.
+    :code:`HTML2Text` objects hold parser state, so each thread (and each worker process) gets its own.
+    """
+    decoder = getattr(_html_decoders, "decoder", None)
+    if decoder is None:
+        import html2text
+
+        decoder = _html_decoders.decoder = html2text.HTML2Text()
+        for k, v in constants.HTML2TEXT_OPTIONS.items():
+            setattr(decoder, k, v)
+    return decoder
+
+
+_html_decoders = threading.local()
+
+
 def decode_message(message, html_decoder=None):
     """
-    Decodes an email message into plain HTML, optionally parsing HTML as well if an HTML2Text object is passed.
+    Decodes the base64 data of a message part to text with :code:`decode_part`, optionally converting HTML
+    to text as well. Retained for compatibility; use :code:`decode_part` and :code:`html_to_text` instead.
 
-    :param message: An :code: `email.message` object
-    :type message: email.message
-    :param html_decoder: :code`HTML2Text` object with the desired configuration, used to parse the message HTML. Defaults to :code:`None`.
-    :type html_decoder: HTML2Text
-    :type parse_html: [TODO:type], optional
+    :param message: Base64-encoded data of a message part
+    :type message: str
+    :param html_decoder: :code:`HTML2Text` object with the desired configuration, used to convert the message HTML. Defaults to :code:`None` (no conversion).
+    :type html_decoder: html2text.HTML2Text, optional
     """
-    message = str(
-        email.message_from_bytes(base64.urlsafe_b64decode(message.encode("ASCII")))
-    )
+    text = decode_part({"body": {"data": message}})
     if html_decoder is not None:
-        message = html_decoder.handle(message)
-    return message
+        text = html_decoder.handle(text)
+    return text
 
 
 def format_print_dict(
     di,
-    subvalue_extract=lambda x: " ".join(x)
-    if isinstance(x, list) and len(x) > 0
-    else format_print_dict(x),
+    subvalue_extract=lambda x: (
+        " ".join(x) if isinstance(x, list) and len(x) > 0 else format_print_dict(x)
+    ),
     none_placeholder="None",
     *args,
 ):
@@ -270,9 +826,11 @@ def format_print_dict(
         [
             fmt.format(
                 (k if k is not None else none_placeholder) + ":",
-                subvalue_extract(v)
-                if subvalue_extract(v) not in (None, [], {})
-                else none_placeholder,
+                (
+                    subvalue_extract(v)
+                    if subvalue_extract(v) not in (None, [], {})
+                    else none_placeholder
+                ),
             )
             for k, v in di.items()
         ]
@@ -286,32 +844,35 @@ def print_sep(char="_", length=80):
 
 def page_response(gmail_service, max_emails=500, *args, **kwargs):
     """
-    Parses a response to a query for emails, iterating over each page in the
-    response object and flattening the result as a list.
+    Lazily iterates over the messages matching a query, requesting only as many
+    as are still needed with each page and stopping once :code:`max_emails` have
+    been yielded.
 
     :param gmail_service: Gmail API client object
     :type gmail_service: googleapiclient.discovery.Resource
-    :param max_emails: Maximum number of emails to return, defaults to 500 (the maximum number a single response can contain).
+    :param max_emails: Maximum number of emails to return, defaults to 500 (the maximum number a single response can contain). If :code:`None`, every matching message is returned.
     :type max_emails: int, optional
     """
 
-    response = {"nextPageToken": ""}
-    messages = []
-
-    while "nextPageToken" in response.keys():
-        pageToken = response["nextPageToken"]
-        response = get_message(gmail_service, *args, pageToken=pageToken, **kwargs)
-        try:
-            messages.extend(
-                response["messages"][
-                    : min(len(response["messages"]), max_emails - len(messages))
-                ]
-            )
-        except:
+    remaining = float("inf") if max_emails is None else max_emails
+    pageToken = None
+
+    while remaining > 0:
+        page_size = int(min(remaining, constants.PAGE_SIZE))
+        response = get_message(
+            gmail_service,
+            *args,
+            pageToken=pageToken,
+            maxResults=page_size,
+            **kwargs,
+        )
+        messages = response.get("messages", [])[:page_size]
+        remaining -= len(messages)
+        yield from messages
+        pageToken = response.get("nextPageToken")
+        if not pageToken:
             break
 
-    return messages
-
 
 # Largely copied from API quickstart
 def create_message(sender, to, subject, message_text=""):
@@ -402,6 +963,8 @@ def send_message(service, message, user_id="me"):
     :param user_id: Gmail user ID of the sender. Defaults to "me" (the id of the person for whom the API service is authorized).
     :type user_id: str, optional
     """
+    from requests.models import HTTPError
+
     try:
         message = (
             service.users().messages().send(userId=user_id, body=message).execute()
@@ -440,54 +1003,116 @@ def reduce_keys(di, keys):
     return reduce(lambda di, key: di[key], keys, di)
 
 
+def build_query(search_args):
+    """Joins the search terms built by :code:`QueryAction` into a Gmail query,
+    removing the "or" flag from :code:`search_args`"""
+    # Choose between OR or AND for search terms
+    combinator = " OR " if (search_args.pop("or")) else " "
+    terms = [v for v in search_args.values() if v is not None]
+    if not terms:
+        exit("No arguments provided")
+    return combinator.join(terms)
+
+
 def parse_emails(gmail_service, search_args, sub_args):
     """Conduct a search for emails using given parameters,
     collects the results, and execute associated subcommand"""
     max_emails = search_args.pop("max_emails")
-    # Choose between OR or AND for search terms
-    combinator = " OR " if (search_args.pop("or")) else " "
-    # output = search_args.pop("output")
-    # download_dir = search_args.pop("download_dir")
+    workers = search_args.pop("workers", None)
+    processes = search_args.pop("processes", None)
+    use_cache = not search_args.pop("no_cache", False)
+    refresh = search_args.pop("refresh", False)
+    store_path = normalize_path(search_args.pop("store", constants.STORE_PATH))
+    # Only store_emails has an output file
+    if "output" in sub_args and sub_args["output"] is None:
+        sub_args["output"] = f"{constants.STORE_OUTPUT}.{sub_args['format']}"
+    request = build_query(search_args)
     search_args = {k: v for k, v in search_args.items() if v is not None}
-    if search_args == {}:
-        exit("No arguments provided")
 
-    # request = ("{" * OR) + " ".join(search_args.values()) + ("}" * OR)
-    request = combinator.join(search_args.values())
-
-    messages = page_response(
-        gmail_service, max_emails=max_emails, userId="me", q=request
+    # Messages already saved by an earlier store_emails --append run are not fetched again
+    skip_ids = None
+    if (
+        sub_args.get("append")
+        and sub_args.get("format") == "ndjson"
+        and sub_args["output"] != "-"
+    ):
+        skip_ids = stored_ids(normalize_path(sub_args["output"]))
+
+    # Answer the query from a recently synced local mirror if possible
+    store = None
+    if use_cache and not refresh and path_exists(store_path):
+        store = classes.LocalStore(store_path)
+        try:
+            if not store.is_fresh():
+                raise classes.UnsupportedQueryError("Local store is stale")
+            ids = store.search(request, max_emails)
+        except classes.UnsupportedQueryError:
+            store.close()
+            store = None
+
+    cache = None
+    if store is not None:
+        if not ids:
+            store.close()
+            print(f"No messages matched query {request!r}")
+            exit()
+        if skip_ids:
+            ids = [id for id in ids if id not in skip_ids]
+        parsed_messages = store.iter_messages(ids)
+    else:
+        # Each stage is a generator, so messages flow through one at a time
+        messages = page_response(
+            gmail_service, max_emails=max_emails, userId="me", q=request
+        )
+        first = next(messages, None)
+        if first is None:
+            print(f"No messages matched query {request!r}")
+            exit()
+
+        ids = (message["id"] for message in chain([first], messages))
+        if skip_ids:
+            ids = (id for id in ids if id not in skip_ids)
+        cache = (_daemon_cache or classes.MessageCache()) if use_cache else None
+        parsed_messages = retrieve_messages(
+            gmail_service,
+            ids,
+            workers=workers,
+            cache=cache,
+            refresh=refresh,
+            headers_only=sub_args.get("headers_only", False),
+            processes=processes,
+        )
+    parsed_messages = unique_messages(parsed_messages)
+    attachment_store = (
+        classes.AttachmentStore(normalize_path(sub_args["attachment_store"]))
+        if sub_args.get("dedup")
+        else None
     )
-
-    if len(messages) == 0:
-        print(f"No messages matched query {request!r}")
-        exit()
-
-    # Extract each payload, yielding MessagePart object
-    raw_messages = [
-        gmail_service.users()
-        .messages()
-        .get(userId="me", id=message["id"])
-        .execute()["payload"]
-        for message in messages
-    ]
-    gen = parse_message(gmail_service, raw_messages)
-    parsed_messages = {mess["id"]: classes.ParsedMessage(**mess) for mess in gen}
     actions = {
         "print_emails": lambda: print_messages(
-            parsed_messages, search_args, sub_args["await"]
+            gmail_service, parsed_messages, search_args, sub_args["await"]
         ),
         "store_emails": lambda: store_messages(
             parsed_messages,
             sub_args["output"],
             validate=True,
             verbose=sub_args["verbose"],
+            output_format=sub_args["format"],
+            flush_every=sub_args["flush_every"],
+            append=sub_args["append"],
+            skip_ids=skip_ids,
+            row_group_size=sub_args["row_group_size"],
+            compression=sub_args["compression"],
         ),
         "download_attachments": lambda: download_attachments(
+            gmail_service,
             parsed_messages,
             sub_args["download_dir"],
             verbose=sub_args["verbose"],
             force=sub_args["force"],
+            buffer_size=sub_args["buffer_size"],
+            workers=workers,
+            store=attachment_store,
         ),
     }
     # Call appropriate subcommand function
@@ -495,13 +1120,289 @@ def parse_emails(gmail_service, search_args, sub_args):
         sub_args["subcommand"],
         lambda *args: exit(f"Unknown subcommand {sub_args['subcommand']!r}"),
     )
-    action()
+    try:
+        action()
+    finally:
+        if constants.DEBUG_TRANSPORT:
+            print_transport_stats()
+        for db in (cache, store, attachment_store):
+            if db is not None and db is not _daemon_cache:
+                db.close()
+
+
+def serve_queries(socket_path=constants.DAEMON_SOCKET):
+    """
+    Serves :code:`gmail_query_emails` requests from :code:`gmail_client` on a Unix domain socket until
+    interrupted. Requests are handled one at a time in this process, so the authenticated client, its HTTP
+    connections, the HTML decoder, and the message cache stay warm between them.
+
+    Each request is a JSON line holding the command-line arguments and the client's working directory.
+    Output is sent back as JSON lines of stdout and stderr text, followed by one holding the exit status.
+
+    :param socket_path: Absolute path of the socket, defaults to :code:`constants.DAEMON_SOCKET`.
+    :type socket_path: str, optional
+    """
+    import socket
+
+    global _daemon_cache
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            # Left behind by a daemon that did not exit cleanly
+            os.unlink(socket_path)
+        else:
+            exit(f"A daemon is already serving {socket_path}")
+        finally:
+            probe.close()
+
+    authenticate()
+    html_decoder()
+    _daemon_cache = classes.MessageCache()
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owner may connect
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    server.listen()
+    print(f"Serving queries on {socket_path}")
+    cwd = os.getcwd()
+    try:
+        while True:
+            connection, _ = server.accept()
+            try:
+                with connection, connection.makefile("rw", encoding="UTF-8") as stream:
+                    handle_query(stream)
+            except OSError:
+                # Client disconnected
+                pass
+            finally:
+                os.chdir(cwd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(socket_path)
+        _daemon_cache.close()
+        _daemon_cache = None
+
+
+def handle_query(stream):
+    """Runs one :code:`gmail_query_emails` request read from a client connection, sending back its output and exit status"""
+    import traceback
+    from contextlib import redirect_stderr, redirect_stdout
+
+    out = classes.FrameWriter(stream, "stdout")
+    err = classes.FrameWriter(stream, "stderr")
+    argv = sys.argv
+    with redirect_stdout(out), redirect_stderr(err):
+        try:
+            request = json.loads(stream.readline())
+            args, cwd = request["args"], request["cwd"]
+            if "--await" in args:
+                exit(
+                    "--await reads from the terminal and is not supported by the daemon"
+                )
+            os.chdir(cwd)
+            # Show the client's program name in usage messages
+            sys.argv = ["gmail_query_emails", *args]
+            command.query_emails(new_args=args)
+            status = 0
+        except SystemExit as e:
+            status = e.code
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                print(status, file=sys.stderr)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.argv = argv
+    stream.write(json.dumps({"exit": status}) + "\n")
+    stream.flush()
+
+
+def sync_mailbox(gmail_service, store, label_id=None, workers=None, full=False):
+    """
+    Mirrors a mailbox, or the messages with a given label, into a local store. The first sync
+    lists and fetches every message; later syncs use the history API to apply only the messages added
+    and deleted and the labels changed since the last one. A full sync is done instead if the
+    scope of the store changed or its history ID has expired. Messages in spam and trash are mirrored
+    too, keeping their labels, so that moving a message in or out of them is just a label change;
+    searches of the store leave them out as Gmail's do. Stores synced before they were mirrored have them
+    added by the next sync.
+
+    :param gmail_service: Gmail API client object
+    :type gmail_service: googleapiclient.discovery.Resource
+    :param store: Local store to sync.
+    :type store: classes.LocalStore
+    :param label_id: ID of a label to restrict the sync to, defaults to :code:`None` (the whole mailbox).
+    :type label_id: str, optional
+    :param workers: Number of threads to fetch messages with, defaults to :code:`None`.
+    :type workers: int, optional
+    :param full: Whether to force a full sync, defaults to False.
+    :type full: bool, optional
+    :return: Dict of counts of messages added, deleted, and relabelled.
+    :rtype: dict
+    """
+    from googleapiclient.errors import HttpError
+
+    history_id = store.get_state("historyId")
+    if store.get_state("labelId") != label_id:
+        store.clear()
+        full = True
+    if not (full or history_id is None):
+        try:
+            counts = sync_history(gmail_service, store, history_id, label_id, workers)
+        except HttpError as e:
+            # History IDs expire after about a week
+            if e.resp.status != 404:
+                raise
+            print("History expired; doing full sync")
+        else:
+            # Stores synced before spam and trash were mirrored lack those messages
+            if not store.get_state("includesSpamTrash"):
+                counts["added"] += sync_spam_trash(
+                    gmail_service, store, label_id, workers
+                )
+            store.set_state("synced", time.time())
+            return counts
+
+    history_id = api_request(
+        gmail_service.users().getProfile, "getProfile", userId="me"
+    ).execute()["historyId"]
+    kwargs = {"includeSpamTrash": True}
+    if label_id is not None:
+        kwargs["labelIds"] = [label_id]
+    listed = {
+        message["id"]
+        for message in page_response(
+            gmail_service, max_emails=None, userId="me", **kwargs
+        )
+    }
+    store.set_state("labelNames", label_decode(gmail_service))
+    stored = store.ids()
+    store.delete(stored - listed)
+    # Refresh labels of messages already stored
+    relabelled = store.set_labels(get_labels(gmail_service, stored & listed))
+    new = listed - stored
+    for message in retrieve_messages(gmail_service, new, workers=workers):
+        store.put(message)
+    store.set_state("labelId", label_id)
+    store.set_state("includesSpamTrash", True)
+    store.set_state("historyId", history_id)
+    store.set_state("synced", time.time())
+    return {
+        "added": len(new),
+        "deleted": len(stored - listed),
+        "relabelled": relabelled,
+    }
+
+
+def get_labels(gmail_service, ids):
+    """Returns the current label IDs of messages, keyed by Gmail ID, fetched in batches of :code:`minimal` requests"""
+    return {
+        message["id"]: message.get("labelIds", [])
+        for message in batch_get_messages(
+            gmail_service,
+            ids,
+            format="minimal",
+            fields=constants.FIELD_MASKS["messages.get.minimal"],
+        )
+    }
+
+
+def sync_spam_trash(gmail_service, store, label_id=None, workers=None):
+    """Adds the messages in spam and trash, and with the label :code:`label_id` if given, to a store,
+    returning the number added"""
+    stored = store.ids()
+    new = set()
+    for label in ("SPAM", "TRASH"):
+        # Listed label IDs must all match
+        label_ids = [label] if label_id is None else [label_id, label]
+        new |= {
+            message["id"]
+            for message in page_response(
+                gmail_service,
+                max_emails=None,
+                userId="me",
+                includeSpamTrash=True,
+                labelIds=label_ids,
+            )
+        }
+    new -= stored
+    for message in retrieve_messages(gmail_service, new, workers=workers):
+        store.put(message)
+    store.set_state("includesSpamTrash", True)
+    return len(new)
+
+
+def sync_history(gmail_service, store, history_id, label_id=None, workers=None):
+    """Applies changes recorded in the mailbox history since :code:`history_id` to a local store"""
+    kwargs = {} if label_id is None else {"labelId": label_id}
+    added, deleted, relabelled = set(), set(), set()
+    pageToken = None
+    while True:
+        response = api_request(
+            gmail_service.users().history().list,
+            "history.list",
+            userId="me",
+            startHistoryId=history_id,
+            pageToken=pageToken,
+            **kwargs,
+        ).execute()
+        for record in response.get("history", []):
+            for change in record.get("messagesAdded", []):
+                added.add(change["message"]["id"])
+                deleted.discard(change["message"]["id"])
+            for change in record.get("messagesDeleted", []):
+                deleted.add(change["message"]["id"])
+                added.discard(change["message"]["id"])
+            for change in record.get("labelsAdded", []) + record.get(
+                "labelsRemoved", []
+            ):
+                relabelled.add(change["message"]["id"])
+        pageToken = response.get("nextPageToken")
+        if not pageToken:
+            break
+
+    store.set_state("labelNames", label_decode(gmail_service))
+    stored = store.ids()
+    # Only the latest labels matter, however many times they changed
+    labels = get_labels(gmail_service, relabelled - deleted - added)
+    # Messages that could not be retrieved have been deleted since
+    deleted |= relabelled - added - labels.keys()
+    if label_id is not None:
+        # Messages leave or enter the slice when the label is removed or added
+        deleted |= {k for k, v in labels.items() if label_id not in v}
+        added |= {k for k, v in labels.items() if label_id in v and k not in stored}
+    else:
+        # Fetch relabelled messages missing from the mirror rather than ignoring them
+        added |= {k for k in labels if k not in stored}
+    store.delete(deleted)
+    changed = store.set_labels({k: v for k, v in labels.items() if k not in deleted})
+    for message in retrieve_messages(gmail_service, added - stored, workers=workers):
+        store.put(message)
+    store.set_state("historyId", response["historyId"])
+    return {
+        "added": len(added - stored),
+        "deleted": len(deleted & stored),
+        "relabelled": changed,
+    }
 
 
-def print_messages(messages, search_args, await_=False):
+def print_messages(gmail_service, messages, search_args, await_=False):
     """Prints all recovered emails in order"""
+    # Collected first so the count can be printed before them, and kept for the options menu
+    messages = list(messages)
     print(f"{len(messages)} email(s) retrieved")
-    for message in messages.values():
+    for message in messages:
         print(message)
         print_sep()
     if await_:
@@ -509,7 +1410,11 @@ def print_messages(messages, search_args, await_=False):
             header="Select option for retrieved emails:",
             options={
                 "Download attachments": lambda: download_attachments(
-                    messages, input("Directory: "), validate=True, verbose=True
+                    gmail_service,
+                    messages,
+                    input("Directory: "),
+                    validate=True,
+                    verbose=True,
                 ),
                 "Store emails": lambda: store_messages(
                     messages, input("Storage file: "), validate=True, verbose=True
@@ -534,41 +1439,290 @@ def print_messages(messages, search_args, await_=False):
 
 
 def download_attachments(
-    messages, download_dir, validate=False, verbose=False, force=False
+    gmail_service,
+    messages,
+    download_dir,
+    validate=False,
+    verbose=False,
+    force=False,
+    buffer_size=constants.DOWNLOAD_BUFFER_SIZE,
+    workers=None,
+    store=None,
 ):
-    """Downloads attachments in returned emails to a specialized directory,
-    overwriting existing files only if specified"""
+    """Downloads attachments in an iterable of returned emails to a specialized directory,
+    overwriting existing files only if specified. Attachments are written in chunks of
+    :code:`buffer_size` bytes. By default they are downloaded one at a time as messages stream in;
+    if :code:`workers` is given, they are collected and downloaded by that many threads, largest first.
+    If an :code:`AttachmentStore` is given, attachments are linked from it, and downloaded into it only
+    if not already stored. A summary of counts and throughput is printed if :code:`verbose`.
+    """
     download_dir = normalize_path(download_dir)
     if validate and not path_writeable(download_dir):
         raise classes.InvalidPathError(download_dir)
 
-    downloaded = []
-    for message in messages.values():
-        for k, v in message.attachments.items():
-            path = os.path.join(download_dir, k)
-            # Only overwrite existing files if instructed
-            if force or not path_exists(path):
-                with open(path, "wb") as f:
-                    f.write(v)
-                    downloaded.append(k)
+    # Only overwrite existing files if instructed
+    jobs = (
+        (os.path.join(download_dir, k), v)
+        for message in messages
+        for k, v in message.attachments.items()
+        if force or not path_exists(os.path.join(download_dir, k))
+    )
+    stats = classes.TransferStats()
+
+    def download(path, handle, credentials=None):
+        start = time.perf_counter()
+        try:
+            http = None if credentials is None else thread_http(credentials)
+            if store is None:
+                written = handle.write_to(
+                    gmail_service, path, buffer_size=buffer_size, http=http
+                )
+            else:
+                written = store.fetch(
+                    gmail_service, handle, path, buffer_size=buffer_size, http=http
+                )
+        except Exception as e:
+            stats.record_failure()
+            print(f"Error downloading {handle.name!r}: {e}")
+            return
+        if written is None:
+            stats.record_link()
+            description = "linked from store"
+        else:
+            description = stats.record(written, time.perf_counter() - start)
+        if verbose:
+            print(f"{handle.name}: {description}")
+
+    if workers:
+        credentials = service_credentials(gmail_service)
+        # Download each path once, as the sequential path does: the first attachment with a
+        # name, or the last if overwriting
+        unique = {}
+        for path, handle in jobs:
+            if force or path not in unique:
+                unique[path] = handle
+        jobs = sorted(unique.items(), key=lambda job: job[1].size or 0, reverse=True)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(download, path, handle, credentials)
+                for path, handle in jobs
+            ]
+            for future in futures:
+                future.result()
+    else:
+        for path, handle in jobs:
+            download(path, handle)
     if verbose:
-        if len(downloaded) > 0:
-            print("Downloaded:\n" + "\n".join(downloaded) + "\ninto " + download_dir)
+        if stats.files + stats.linked + stats.failed > 0:
+            print(f"Downloaded {stats.summary()} into {download_dir}")
         else:
             print("No attachments downloaded")
 
 
-def store_messages(messages, output, validate=False, verbose=False):
-    """Saves returned email messages to a specified path"""
-    filename = normalize_path(output.name if type(output) is TextIOWrapper else output)
-
-    if validate and not path_writeable(filename, allow_overwrite=True):
+def store_messages(
+    messages,
+    output,
+    validate=False,
+    verbose=False,
+    output_format="json",
+    flush_every=constants.FLUSH_EVERY,
+    append=False,
+    skip_ids=None,
+    row_group_size=constants.PARQUET_ROW_GROUP_SIZE,
+    compression=constants.PARQUET_COMPRESSION,
+):
+    """
+    Saves an iterable of returned email messages to a specified path, writing each as it arrives
+    (or, for Parquet, each row group as it fills).
+
+    :param messages: Messages to save
+    :type messages: Iterable[classes.ParsedMessage]
+    :param output: Path of the output file, or :code:`"-"` for standard output
+    :type output: str
+    :param validate: Whether to check that the output file can be written first, defaults to False.
+    :type validate: bool, optional
+    :param verbose: Whether to print the number of messages saved, defaults to False.
+    :type verbose: bool, optional
+    :param output_format: "json" to save a JSON object keyed by message ID, "ndjson" to save one JSON object per line, each with the message's :code:`id` and :code:`gmail_id`, or "parquet" to save a Parquet table (see :code:`store_parquet`). Defaults to "json".
+    :type output_format: str, optional
+    :param flush_every: Number of messages to write between flushes, defaults to :code:`constants.FLUSH_EVERY`.
+    :type flush_every: int, optional
+    :param append: Whether to append to an existing ndjson file, skipping messages it contains, defaults to False.
+    :type append: bool, optional
+    :param skip_ids: Message IDs or Gmail IDs to skip when appending, defaults to those in the file (see :code:`stored_ids`).
+    :type skip_ids: Set[str], optional
+    :param row_group_size: Number of messages per Parquet row group, defaults to :code:`constants.PARQUET_ROW_GROUP_SIZE`.
+    :type row_group_size: int, optional
+    :param compression: Compression codec of Parquet output, defaults to :code:`constants.PARQUET_COMPRESSION`.
+    :type compression: str, optional
+    """
+    filename = output if output == "-" else normalize_path(output)
+    if append and output_format != "ndjson":
+        exit("--append requires --format ndjson")
+    if (
+        validate
+        and filename != "-"
+        and not path_writeable(filename, allow_overwrite=True)
+    ):
         raise classes.InvalidPathError(filename)
-    messages = {k: v.data for k, v in messages.items()}
-    with open(filename, "w") as f:
-        json.dump(messages, f)
+
+    if output_format == "parquet":
+        n = store_parquet(messages, filename, row_group_size, compression)
+        if verbose:
+            print(f"Saved {n} email(s) to {filename}", file=stderr)
+        return
+
+    if append and filename != "-":
+        if skip_ids is None:
+            skip_ids = stored_ids(filename)
+        truncate_partial_line(filename)
+    skip_ids = skip_ids or set()
+    n = skipped = 0
+    with (
+        nullcontext(sys.stdout)
+        if filename == "-"
+        else open(filename, "a" if append else "w")
+    ) as f:
+        if output_format == "json":
+            # Write the JSON object one message at a time rather than building it in memory
+            f.write("{")
+        for message in messages:
+            if message.gmail_id in skip_ids or message.id in skip_ids:
+                skipped += 1
+                continue
+            n += 1
+            if output_format == "ndjson":
+                record = {
+                    "id": message.id,
+                    "gmail_id": message.gmail_id,
+                    **message.data,
+                }
+                f.write(json.dumps(record) + "\n")
+            else:
+                if n > 1:
+                    f.write(", ")
+                f.write(f"{json.dumps(message.id)}: {json.dumps(message.data)}")
+            if n % flush_every == 0:
+                f.flush()
+        if output_format == "json":
+            f.write("}")
     if verbose:
-        print(f"Saved {len(messages)} email(s) to {filename}")
+        print(
+            f"Saved {n} email(s) to {filename}"
+            + (f", skipping {skipped} already saved" if skipped else ""),
+            file=stderr,
+        )
+
+
+def store_parquet(
+    messages,
+    path,
+    row_group_size=constants.PARQUET_ROW_GROUP_SIZE,
+    compression=constants.PARQUET_COMPRESSION,
+):
+    """
+    Saves messages to a Parquet file, writing one row group of record batches at a time so that at most
+    :code:`row_group_size` messages are held in memory. Columns are the lower-cased keys of
+    :code:`ParsedMessage.data`, with the date parsed to a UTC timestamp and the attachment count as an
+    integer, followed by :code:`id`, :code:`gmail_id`, :code:`labels`, and :code:`size`. Requires :code:`pyarrow`.
+
+    :param messages: Messages to save
+    :type messages: Iterable[classes.ParsedMessage]
+    :param path: Path of the output file
+    :type path: str
+    :param row_group_size: Number of messages per row group, defaults to :code:`constants.PARQUET_ROW_GROUP_SIZE`.
+    :type row_group_size: int, optional
+    :param compression: Compression codec, defaults to :code:`constants.PARQUET_COMPRESSION`.
+    :type compression: str, optional
+    :return: Number of messages saved
+    :rtype: int
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        exit("--format parquet requires pyarrow. Install it with: pip install pyarrow")
+
+    # Types of the columns that are not strings
+    types = {
+        "Date": pa.timestamp("us", tz="UTC"),
+        "Attachments": pa.int32(),
+        "labels": pa.list_(pa.string()),
+        "size": pa.int64(),
+    }
+    # The fields of an empty message give the columns even if there are no messages
+    keys = list(classes.ParsedMessage(None, None).data.keys())
+    keys += ["id", "gmail_id", "labels", "size"]
+    schema = pa.schema([(key.lower(), types.get(key, pa.string())) for key in keys])
+
+    def values(message):
+        fields = {
+            **message.data,
+            "Date": message.timestamp,
+            "id": message.id,
+            "gmail_id": message.gmail_id,
+            "labels": message.labels,
+            "size": message.size,
+        }
+        return [fields[key] for key in keys]
+
+    n = 0
+    with pq.ParquetWriter(
+        path, schema, compression=None if compression == "none" else compression
+    ) as writer:
+        for chunk in chunked(messages, row_group_size):
+            columns = zip(*(values(message) for message in chunk))
+            batch = pa.RecordBatch.from_arrays(
+                [
+                    pa.array(column, type=field.type)
+                    for column, field in zip(columns, schema)
+                ],
+                schema=schema,
+            )
+            writer.write_batch(batch, row_group_size=row_group_size)
+            n += len(chunk)
+    return n
+
+
+def stored_ids(path):
+    """Returns the set of message IDs and Gmail IDs of the records in an ndjson file, ignoring malformed lines"""
+    ids = set()
+    if not path_exists(path):
+        return ids
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            ids.update(
+                record[k] for k in ("id", "gmail_id") if record.get(k) is not None
+            )
+    return ids
+
+
+def truncate_partial_line(path):
+    """Removes an incomplete last line, such as one left by an interrupted write, from a file"""
+    if not path_exists(path):
+        return
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        # Search backwards for the last newline
+        position = size
+        while position > 0:
+            step = min(position, constants.DOWNLOAD_BUFFER_SIZE)
+            f.seek(position - step)
+            chunk = f.read(step)
+            if position == size and chunk.endswith(b"\n"):
+                return
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                f.truncate(position - step + newline + 1)
+                return
+            position -= step
+        f.truncate(0)
 
 
 def new_search(messages, search_args, mode):
@@ -576,7 +1730,7 @@ def new_search(messages, search_args, mode):
     whether to append to an existing search or start a new one"""
     if mode not in ("new", "additional"):
         raise ValueError(f"Mode must be 'new' or 'additional', not {mode!r}")
-    ids = " ".join([k for k in messages.keys()])
+    ids = " ".join([message.id for message in messages])
     prompt = f"Enter {mode} search terms: "
     while True:
         try:
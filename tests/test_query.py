@@ -0,0 +1,204 @@
+import datetime
+
+import pytest
+
+from Gmailtools.classes import GmailQuery, LocalStore, UnsupportedQueryError
+
+LABELS = "id IN (SELECT id FROM message_labels WHERE label IN (?, ?))"
+WORD = "id IN (SELECT id FROM terms WHERE word = ?)"
+
+
+@pytest.fixture
+def store(tmp_path):
+    with LocalStore(str(tmp_path / "store.sqlite")) as store:
+        yield store
+
+
+def compile_query(store, query):
+    return store._compile(GmailQuery(query).parse())
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ("from:alice", ("and", [("term", "from", "alice")])),
+        ("FROM:alice", ("and", [("term", "from", "alice")])),
+        ("hello", ("and", [("term", None, "hello")])),
+        (
+            "from:alice to:bob",
+            ("and", [("term", "from", "alice"), ("term", "to", "bob")]),
+        ),
+        ("", ("and", [])),
+    ],
+)
+def test_parse_terms(query, expected):
+    assert GmailQuery(query).parse() == expected
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ('"hello world"', ("and", [("term", None, "hello world")])),
+        ('subject:"weekly report"', ("and", [("term", "subject", "weekly report")])),
+        ('-"hello world"', ("and", [("not", ("term", None, "hello world"))])),
+        ('"a (b) {c}"', ("and", [("term", None, "a (b) {c}")])),
+    ],
+)
+def test_parse_quoting(query, expected):
+    assert GmailQuery(query).parse() == expected
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ("-from:alice", ("and", [("not", ("term", "from", "alice"))])),
+        (
+            "-{from:alice from:bob}",
+            (
+                "and",
+                [("not", ("or", [("term", "from", "alice"), ("term", "from", "bob")]))],
+            ),
+        ),
+        (
+            "-(from:alice to:bob)",
+            (
+                "and",
+                [("not", ("and", [("term", "from", "alice"), ("term", "to", "bob")]))],
+            ),
+        ),
+    ],
+)
+def test_parse_negation(query, expected):
+    assert GmailQuery(query).parse() == expected
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        (
+            "from:alice OR from:bob",
+            ("and", [("or", [("term", "from", "alice"), ("term", "from", "bob")])]),
+        ),
+        (
+            "{from:alice from:bob}",
+            ("and", [("or", [("term", "from", "alice"), ("term", "from", "bob")])]),
+        ),
+        (
+            "{from:alice OR from:bob} to:carol",
+            (
+                "and",
+                [
+                    ("or", [("term", "from", "alice"), ("term", "from", "bob")]),
+                    ("term", "to", "carol"),
+                ],
+            ),
+        ),
+        (
+            "(from:alice to:bob) OR subject:hi",
+            (
+                "and",
+                [
+                    (
+                        "or",
+                        [
+                            ("and", [("term", "from", "alice"), ("term", "to", "bob")]),
+                            ("term", "subject", "hi"),
+                        ],
+                    )
+                ],
+            ),
+        ),
+    ],
+)
+def test_parse_or_and_groups(query, expected):
+    assert GmailQuery(query).parse() == expected
+
+
+@pytest.mark.parametrize(
+    "query", ["{from:alice", "(from:alice", "from:alice}", "from:alice OR", "- from:a"]
+)
+def test_parse_malformed(query):
+    with pytest.raises(UnsupportedQueryError):
+        GmailQuery(query).parse()
+
+
+@pytest.mark.parametrize(
+    "query,expected",
+    [
+        ("from:Alice", ("(sender LIKE ? ESCAPE '\\')", ["%alice%"])),
+        ("to:bob", ("(recipient LIKE ? ESCAPE '\\')", ["%bob%"])),
+        ("subject:100%_done", ("(subject LIKE ? ESCAPE '\\')", ["%100\\%\\_done%"])),
+        ("hello", (f"({WORD})", ["hello"])),
+        ('"Hello, world"', (f"({WORD} AND {WORD})", ["hello", "world"])),
+        ("rfc822msgid:<a@b>", ("(rfc_id IN (?, ?))", ["a@b", "<a@b>"])),
+        (
+            "filename:pdf",
+            (
+                "(id IN (SELECT id FROM filenames WHERE name = ? OR name LIKE ?))",
+                ["pdf", "%.pdf"],
+            ),
+        ),
+        ("has:attachment", ("(id IN (SELECT id FROM filenames))", [])),
+        ("label:work", (f"({LABELS})", ["work", "WORK"])),
+        ("is:read", (f"(NOT ({LABELS}))", ["unread", "UNREAD"])),
+        ("in:anywhere", ("(1)", [])),
+        ("", ("1", [])),
+    ],
+)
+def test_compile_operators(store, query, expected):
+    assert compile_query(store, query) == expected
+
+
+def test_compile_label_names(store):
+    store.set_state("labelNames", {"Label_1": "Work/Projects"})
+    assert compile_query(store, "label:work-projects") == (
+        "(id IN (SELECT id FROM message_labels WHERE label IN (?, ?, ?)))",
+        ["work-projects", "WORK-PROJECTS", "Label_1"],
+    )
+
+
+def test_compile_negation(store):
+    assert compile_query(store, "-from:alice") == (
+        "(NOT (sender LIKE ? ESCAPE '\\'))",
+        ["%alice%"],
+    )
+    assert compile_query(store, "-{from:alice to:bob}") == (
+        "(NOT ((sender LIKE ? ESCAPE '\\') OR (recipient LIKE ? ESCAPE '\\')))",
+        ["%alice%", "%bob%"],
+    )
+
+
+def test_compile_or_and_groups(store):
+    assert compile_query(store, "{from:alice from:bob} subject:hi") == (
+        "((sender LIKE ? ESCAPE '\\') OR (sender LIKE ? ESCAPE '\\'))"
+        " AND (subject LIKE ? ESCAPE '\\')",
+        ["%alice%", "%bob%", "%hi%"],
+    )
+    assert compile_query(store, "from:alice OR (to:bob subject:hi)") == (
+        "((sender LIKE ? ESCAPE '\\') OR ((recipient LIKE ? ESCAPE '\\')"
+        " AND (subject LIKE ? ESCAPE '\\')))",
+        ["%alice%", "%bob%", "%hi%"],
+    )
+
+
+@pytest.mark.parametrize(
+    "query,operator,date",
+    [
+        ("after:2020/01/02", ">=", datetime.datetime(2020, 1, 2)),
+        ("before:2020-01-02", "<", datetime.datetime(2020, 1, 2)),
+        ("after:01/02/2020", ">=", datetime.datetime(2020, 1, 2)),
+        ("before:2020.1.2", "<", datetime.datetime(2020, 1, 2)),
+    ],
+)
+def test_compile_dates(store, query, operator, date):
+    assert compile_query(store, query) == (f"(date {operator} ?)", [date.timestamp()])
+
+
+def test_compile_epoch_date(store):
+    assert compile_query(store, "after:1577923200") == ("(date >= ?)", [1577923200.0])
+
+
+@pytest.mark.parametrize("query", ["after:yesterday", "newer_than:1d", "larger:10M"])
+def test_compile_unsupported(store, query):
+    with pytest.raises(UnsupportedQueryError):
+        compile_query(store, query)